@@ -12,11 +12,14 @@ else:
     import pickle
 import torch
 import torch.utils.data as data
+import torch.distributed as dist
 from torch.autograd import Variable
 import torchvision.transforms as transforms
 import clip as clip
 import torch.nn.functional as F
-from lib.utils_image import imresize
+from easydict import EasyDict as edict
+from tqdm import tqdm
+from lib.utils_image import imresize_batch
 
 def get_fix_data(train_dl, test_dl, text_encoder, args):
     fixed_image_train,LR1, _, _, fixed_sent_train, fixed_word_train, fixed_key_train = get_one_batch_data(train_dl, text_encoder, args)
@@ -38,9 +41,15 @@ def get_one_batch_data(dataloader, text_encoder, args):
 
 
 def prepare_data(data, text_encoder, device):
-    imgs,LR, captions, CLIP_tokens, keys = data
-    imgs, CLIP_tokens = imgs.to(device), CLIP_tokens.to(device)
-    sent_emb, words_embs = encode_tokens(text_encoder, CLIP_tokens)
+    if len(data) == 6:
+        # embeddings come from the text cache, the text encoder is not needed
+        imgs,LR, captions, sent_emb, words_embs, keys = data
+        imgs, CLIP_tokens = imgs.to(device), None
+        sent_emb, words_embs = sent_emb.to(device), words_embs.to(device)
+    else:
+        imgs,LR, captions, CLIP_tokens, keys = data
+        imgs, CLIP_tokens = imgs.to(device), CLIP_tokens.to(device)
+        sent_emb, words_embs = encode_tokens(text_encoder, CLIP_tokens)
 
     LR=LR.to(device)
     return imgs, LR,captions, CLIP_tokens, sent_emb, words_embs, keys
@@ -74,17 +83,208 @@ def get_imgs(img_path, bbox=None, transform=None, normalize=None):
     return img
 
 
-def get_caption(cap_path,clip_info):
+def load_captions(cap_path):
     eff_captions = []
     with open(cap_path, "r") as f:
         captions = f.read().encode('utf-8').decode('utf8').split('\n')
     for cap in captions:
         if len(cap) != 0:
             eff_captions.append(cap)
-    sent_ix = random.randint(0, len(eff_captions))
-    caption = eff_captions[sent_ix]
-    tokens = clip.tokenize(caption,truncate=True)
-    return caption, tokens[0]
+    return eff_captions
+
+
+def write_atomic(path, save):
+    # save(f) writes to a temp file that replaces path in one step, so no reader sees
+    # a half-written file; a failed write (e.g. a read-only data_dir) is only reported
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            save(f)
+        os.replace(tmp_path, path)
+        return True
+    except OSError as e:
+        print('Could not write %s: %s' % (path, e))
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+
+def load_on_rank0(read, build, write):
+    # read(check) returns None for a missing (or, with check, stale) cache and write()
+    # returns whether it succeeded; only rank 0 checks the cache and, if needed, builds
+    # and writes it, the other ranks trust it after rank 0 is done, or build their own
+    # copy in memory if the write failed
+    distributed = dist.is_available() and dist.is_initialized()
+    table, cached = None, True
+    if not distributed or dist.get_rank() == 0:
+        table = read(True)
+        if table is None:
+            table = build()
+            cached = write(table)
+    if distributed:
+        # also the barrier, the other ranks wait for rank 0
+        flag = [cached]
+        dist.broadcast_object_list(flag, src=0)
+        if table is None and flag[0]:
+            table = read(False)
+        if table is None:
+            table = build()
+    return table
+
+
+
+################################################################
+#                    Shards
+################################################################
+class ShardWriter:
+    """Appends uint8 arrays to memory-mapped shard files of at most shard_size bytes."""
+    def __init__(self, shard_dir, shard_size):
+        self.shard_dir = shard_dir
+        self.shard_size = shard_size
+        self.shard_names = []
+        self.shard = None
+        self.offset = 0
+
+    def new_shard(self):
+        self.close()
+        name = 'shard_%04d.bin' % len(self.shard_names)
+        self.shard_names.append(name)
+        self.shard = np.memmap(os.path.join(self.shard_dir, name), dtype=np.uint8, mode='w+', shape=(self.shard_size,))
+        self.offset = 0
+
+    def write(self, arrays):
+        nbytes = sum(arr.nbytes for arr in arrays)
+        if nbytes > self.shard_size:
+            raise ValueError('Record of %d bytes does not fit in a shard of %d bytes.' % (nbytes, self.shard_size))
+        if self.shard is None or self.offset + nbytes > self.shard_size:
+            self.new_shard()
+        begin = self.offset
+        for arr in arrays:
+            self.shard[self.offset:self.offset + arr.nbytes] = arr.reshape(-1)
+            self.offset += arr.nbytes
+        return len(self.shard_names) - 1, begin
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.flush()
+            del self.shard
+            self.shard = None
+            # drop the unused tail of the shard
+            os.truncate(os.path.join(self.shard_dir, self.shard_names[-1]), self.offset)
+
+
+class ShardReader:
+    """Zero-copy HR views into the shard files written by prepare_shards."""
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.pickle'), 'rb') as f:
+            index = pickle.load(f)
+        self.shard_names = index['shards']
+        self.records = index['records']
+        self.rows = {key: row for row, key in enumerate(index['keys'])}
+        self.shards = {}
+
+    def __getstate__(self):
+        # memmaps are re-opened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['shards'] = {}
+        return state
+
+    def get_shard(self, shard_id):
+        if shard_id not in self.shards:
+            path = os.path.join(self.shard_dir, self.shard_names[shard_id])
+            self.shards[shard_id] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self.shards[shard_id]
+
+    def __getitem__(self, key):
+        shard_id, offset, H, W = self.records[self.rows[key]]
+        return self.get_shard(shard_id)[offset:offset + H * W * 3].reshape(H, W, 3)
+
+
+def prepare_shards(args, split, shard_size=1 << 30):
+    """Decode, bbox-crop and resize a split once and store the uint8 images in args.shard_dir.
+
+    The LR is not stored: like the JPEG pipeline, TextImgDataset degrades each
+    random crop, so the LR borders come from the crop and not from its
+    neighbourhood in the full image.
+    """
+    raw_args = edict(dict(args))
+    raw_args.shard_dir, raw_args.text_cache = None, None
+    resize = transforms.Resize(int(args.imsize * 76 / 64))
+    dataset = TextImgDataset(split=split, transform=resize, args=raw_args)
+    shard_dir = os.path.join(args.shard_dir, split)
+    os.makedirs(shard_dir, exist_ok=True)
+    writer = ShardWriter(shard_dir, shard_size)
+    keys, records = [], []
+    for filename in tqdm(dataset.filenames):
+        key = filename.removesuffix('.jpg')
+        img_name, _ = dataset.get_paths(key)
+        bbox = dataset.get_bbox(key)
+        HR = np.asarray(get_imgs(img_name, bbox, resize), dtype=np.uint8)
+        shard_id, offset = writer.write([HR])
+        keys.append(key)
+        records.append((shard_id, offset) + HR.shape[:2])
+    writer.close()
+    index = {'shards': writer.shard_names, 'keys': keys, 'records': np.array(records, dtype=np.int64)}
+    with open(os.path.join(shard_dir, 'index.pickle'), 'wb') as f:
+        pickle.dump(index, f)
+    print('Write %d samples into %d shards: %s' % (len(keys), len(writer.shard_names), shard_dir))
+
+
+################################################################
+#                    Text cache
+################################################################
+class TextCache:
+    """Zero-copy (sent_emb, words_embs) lookup by caption, written by prepare_text_cache."""
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, 'captions.pickle'), 'rb') as f:
+            captions = pickle.load(f)
+        self.rows = {cap: row for row, cap in enumerate(captions)}
+        self.embs = None
+
+    def __getstate__(self):
+        # memmaps are re-opened lazily in each DataLoader worker
+        state = self.__dict__.copy()
+        state['embs'] = None
+        return state
+
+    def __getitem__(self, caption):
+        if self.embs is None:
+            self.embs = [np.load(os.path.join(self.cache_dir, name), mmap_mode='r')
+                            for name in ['sent_emb.npy', 'words_embs.npy']]
+        row = self.rows[caption]
+        sent_emb, words_embs = self.embs
+        return torch.from_numpy(np.array(sent_emb[row])), torch.from_numpy(np.array(words_embs[row]))
+
+
+def prepare_text_cache(args, text_encoder, batch_size=256):
+    """Encode every caption line of the train and test splits once and store the embeddings in args.text_cache."""
+    raw_args = edict(dict(args))
+    raw_args.shard_dir, raw_args.text_cache = None, None
+    captions = set()
+    for split in ['train', 'test']:
+        dataset = TextImgDataset(split=split, transform=None, args=raw_args)
+        captions.update(dataset.captions)
+    captions = sorted(captions)
+    os.makedirs(args.text_cache, exist_ok=True)
+    sent_embs, words_embs = None, None
+    for begin in tqdm(range(0, len(captions), batch_size)):
+        tokens = clip.tokenize(captions[begin:begin + batch_size], truncate=True).to(args.device)
+        sent_emb, words_emb = encode_tokens(text_encoder, tokens)
+        sent_emb, words_emb = sent_emb.cpu().numpy(), words_emb.cpu().numpy()
+        if sent_embs is None:
+            sent_embs = np.lib.format.open_memmap(os.path.join(args.text_cache, 'sent_emb.npy'), mode='w+',
+                            dtype=sent_emb.dtype, shape=(len(captions),) + sent_emb.shape[1:])
+            words_embs = np.lib.format.open_memmap(os.path.join(args.text_cache, 'words_embs.npy'), mode='w+',
+                            dtype=words_emb.dtype, shape=(len(captions),) + words_emb.shape[1:])
+        sent_embs[begin:begin + batch_size] = sent_emb
+        words_embs[begin:begin + batch_size] = words_emb
+    sent_embs.flush()
+    words_embs.flush()
+    with open(os.path.join(args.text_cache, 'captions.pickle'), 'wb') as f:
+        pickle.dump(captions, f)
+    print('Write %d caption embeddings into: %s' % (len(captions), args.text_cache))
 
 
 ################################################################
@@ -103,36 +303,60 @@ class TextImgDataset(data.Dataset):
         self.split=split
         
         if self.data_dir.find('birds') != -1:
-            self.bbox = self.load_bbox()
+            self.bbox, self.bbox_rows = self.load_bbox()
         else:
-            self.bbox = None
+            self.bbox, self.bbox_rows = None, None
         self.split_dir = os.path.join(self.data_dir, split)
         self.filenames = self.load_filenames(self.data_dir, split)
         self.number_example = len(self.filenames)
+        self.captions, self.caption_tokens, self.caption_offsets = self.load_caption_table(self.data_dir, split)
+        # read decoded HR/LR pairs written by prepare_shards instead of JPEGs
+        if args.shard_dir:
+            self.imsize = args.imsize
+            self.crop_step, self.flip = args.shard_crop_step, args.shard_flip
+            # with the real feature cache the crops snap to a fixed grid, so they repeat
+            self.crop_grid = args.feat_cache_crops if args.feat_cache_size else 0
+            self.shards = ShardReader(os.path.join(args.shard_dir, split))
+        else:
+            self.shards = None
+        # return cached CLIP text embeddings written by prepare_text_cache instead of tokens
+        if args.text_cache:
+            self.text_cache = TextCache(args.text_cache)
+        else:
+            self.text_cache = None
 
     def load_bbox(self):
+        # bbox = [x-left, y-top, width, height], one row per CUB image; the
+        # parsed table is cached in a binary sidecar next to bounding_boxes.txt
         data_dir = self.data_dir
         bbox_path = os.path.join(data_dir, 'CUB_200_2011/bounding_boxes.txt')
-        df_bounding_boxes = pd.read_csv(bbox_path,
-                                        delim_whitespace=True,
-                                        header=None).astype(int)
-        #
         filepath = os.path.join(data_dir, 'CUB_200_2011/images.txt')
-        df_filenames = \
-            pd.read_csv(filepath, delim_whitespace=True, header=None)
-        filenames = df_filenames[1].tolist()
-        print('Total filenames: ', len(filenames), filenames[0])
-        #
-        filename_bbox = {img_file[:-4]: [] for img_file in filenames}
-        numImgs = len(filenames)
-        for i in range(0, numImgs):
-            # bbox = [x-left, y-top, width, height]
-            bbox = df_bounding_boxes.iloc[i][1:].tolist()
-            key = filenames[i][:-4]
-            filename_bbox[key] = bbox
-        return filename_bbox
+        cache_path = os.path.join(data_dir, 'CUB_200_2011/bounding_boxes.npz')
+
+        def read(check):
+            if not os.path.isfile(cache_path) or check and \
+                os.path.getmtime(cache_path) < max(os.path.getmtime(bbox_path), os.path.getmtime(filepath)):
+                return None
+            with np.load(cache_path) as f:
+                return f['keys'], f['bbox']
 
+        def build():
+            bbox = pd.read_csv(bbox_path, sep=r'\s+', header=None).to_numpy()[:, 1:].astype(np.int64)
+            df_filenames = pd.read_csv(filepath, sep=r'\s+', header=None)
+            return df_filenames[1].str[:-4].to_numpy(dtype=str), bbox
 
+        def write(table):
+            return write_atomic(cache_path, lambda f: np.savez(f, keys=table[0], bbox=table[1]))
+
+        keys, bbox = load_on_rank0(read, build, write)
+        print('Total filenames: ', len(keys), keys[0])
+        rows = {key: row for row, key in enumerate(keys.tolist())}
+        return bbox, rows
+
+    def get_bbox(self, key):
+        if self.bbox is None:
+            return None
+        return self.bbox[self.bbox_rows[key]]
 
     def load_filenames(self, data_dir, split):
         filepath = '%s/%s/filenames.pickle' % (data_dir, split)
@@ -145,17 +369,60 @@ class TextImgDataset(data.Dataset):
             filenames = []
         return filenames
 
-    def __getitem__(self, index):
-        #
-        key = self.filenames[index]
-        key = key.removesuffix('.jpg')
-        data_dir = self.data_dir
-        #
-        if self.bbox is not None:
-            bbox = self.bbox[key]
-        else:
-            bbox = None
+    def caption_stamps(self):
+        # (mtime_ns, size) of every caption file, an edited .txt invalidates the table
+        stamps = []
+        for filename in self.filenames:
+            _, text_name = self.get_paths(filename.removesuffix('.jpg'))
+            stat = os.stat(text_name)
+            stamps.append((stat.st_mtime_ns, stat.st_size))
+        return stamps
+
+    def read_caption_table(self, filepath, stamps=None):
+        # stamps None trusts the table, e.g. right after rank 0 checked or wrote it
+        if not os.path.isfile(filepath):
+            return None
+        with open(filepath, 'rb') as f:
+            table = pickle.load(f)
+        if table['filenames'] != self.filenames or stamps is not None and table.get('stamps') != stamps:
+            return None
+        print('Load captions from: %s (%d)' % (filepath, len(table['captions'])))
+        return table
+
+    def build_caption_table(self, stamps):
+        captions, offsets = [], [0]
+        for filename in self.filenames:
+            _, text_name = self.get_paths(filename.removesuffix('.jpg'))
+            captions += load_captions(text_name)
+            offsets.append(len(captions))
+        tokens = clip.tokenize(captions, truncate=True).numpy().astype(np.int32)
+        return {'filenames': self.filenames, 'stamps': stamps, 'captions': captions, 'tokens': tokens,
+                'offsets': np.array(offsets, dtype=np.int64)}
 
+    def load_caption_table(self, data_dir, split):
+        # all caption lines of the split, tokenized once; the captions of
+        # filenames[i] are rows caption_offsets[i]:caption_offsets[i+1]
+        filepath = '%s/%s/captions.pickle' % (data_dir, split)
+        # the caption files are only stat'ed by the rank that checks the table
+        stamps = None
+
+        def read(check):
+            nonlocal stamps
+            if check:
+                stamps = self.caption_stamps()
+            return self.read_caption_table(filepath, stamps)
+
+        def write(table):
+            if not write_atomic(filepath, lambda f: pickle.dump(table, f)):
+                return False
+            print('Write captions to: %s (%d)' % (filepath, len(table['captions'])))
+            return True
+
+        table = load_on_rank0(read, lambda: self.build_caption_table(stamps), write)
+        return table['captions'], table['tokens'], table['offsets']
+
+    def get_paths(self, key):
+        data_dir = self.data_dir
         if self.dataset_name.lower().find('coco') != -1:
             if self.split=='train':
                 img_name = '%s/train/%s.jpg' % (data_dir, key)
@@ -175,10 +442,58 @@ class TextImgDataset(data.Dataset):
         else:
             img_name = '%s/CUB_200_2011/images/%s.jpg' % (data_dir, key)
             text_name = '%s/text/%s.txt' % (data_dir, key)
+        return img_name, text_name
+
+    def grid_offset(self, size):
+        # one of crop_grid offsets spread evenly over the margin
+        if self.crop_grid == 1:
+            return (size - self.imsize) // 2
+        idx = random.randint(0, self.crop_grid)
+        return (size - self.imsize) * idx // (self.crop_grid - 1)
+
+    def get_shard_imgs(self, key):
+        # random crop on a crop_step grid and random flip; crop_step 0 takes the center
+        # crop, and crop_grid (set while the feature cache is on) picks one of
+        # crop_grid x crop_grid fixed crops. The LR is degraded from the crop, as in
+        # the JPEG pipeline
+        HR = self.shards[key]
+        height, width = HR.shape[:2]
+        if self.crop_grid:
+            top, left = self.grid_offset(height), self.grid_offset(width)
+        elif self.crop_step:
+            top = random.randint(0, (height - self.imsize) // self.crop_step + 1) * self.crop_step
+            left = random.randint(0, (width - self.imsize) // self.crop_step + 1) * self.crop_step
+        else:
+            top, left = (height - self.imsize) // 2, (width - self.imsize) // 2
+        HR = HR[top:top + self.imsize, left:left + self.imsize]
+        flip = int(self.flip and random.rand() < 0.5)
+        if flip:
+            HR = HR[:, ::-1]
+        # the same arithmetic as ToTensor and Normalize((0.5,)*3, (0.5,)*3)
+        HR = (torch.from_numpy(np.ascontiguousarray(HR)).permute(2, 0, 1).float() / 255. - 0.5) / 0.5
+        LR = imresize_batch(HR, 1 / 4, True)
+        return HR, LR, (top, left, flip)
 
-        imgs = get_imgs(img_name, bbox, self.transform, normalize=self.norm)
-        LR =imresize(imgs, 1 /4, True)
-        caps,tokens = get_caption(text_name,self.clip4text)
+    def __getitem__(self, index):
+        #
+        key = self.filenames[index]
+        key = key.removesuffix('.jpg')
+        img_name, _ = self.get_paths(key)
+        #
+        if self.shards is not None:
+            imgs, LR, aug = self.get_shard_imgs(key)
+            # the augmentation is part of the sample key, e.g. for the real feature cache
+            key = '%s@%d,%d,%d' % ((key,) + aug)
+        else:
+            bbox = self.get_bbox(key)
+            imgs = get_imgs(img_name, bbox, self.transform, normalize=self.norm)
+            LR =imresize_batch(imgs, 1 /4, True)
+        sent_ix = random.randint(self.caption_offsets[index], self.caption_offsets[index + 1])
+        caps = self.captions[sent_ix]
+        if self.text_cache is not None:
+            sent_emb, words_embs = self.text_cache[caps]
+            return imgs,LR, caps, sent_emb, words_embs, key
+        tokens = torch.from_numpy(self.caption_tokens[sent_ix])
         return imgs,LR, caps, tokens, key
 
     def __len__(self):
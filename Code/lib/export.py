@@ -0,0 +1,122 @@
+import os
+import json
+import inspect
+
+import torch
+import torch.nn as nn
+
+
+class GeneratorGraph(nn.Module):
+    """NetG in eval mode with a tensor only signature, the form that gets traced."""
+    def __init__(self, netG):
+        super(GeneratorGraph, self).__init__()
+        self.netG = netG
+
+    def forward(self, LR, c):
+        return self.netG(LR, c, eval=True)
+
+
+class TextGraph(nn.Module):
+    """CLIP_TXT_ENCODER returning only the sentence embedding, as NetG uses it."""
+    def __init__(self, text_encoder):
+        super(TextGraph, self).__init__()
+        self.text_encoder = text_encoder
+
+    def forward(self, tokens):
+        sent_emb, words_embs = self.text_encoder(tokens)
+        return sent_emb.float()
+
+
+class ExportedNetG:
+    """Runs an exported generator like NetG.
+
+    The exported graph has a fixed batch size, so inputs are split into
+    chunks of that size and the last chunk is padded by repeating its final
+    sample. A sentence embedding of batch size 1 is shared by all images.
+    """
+    def __init__(self, module, meta):
+        self.module = module
+        self.meta = meta
+        self.batch_size = meta['batch_size']
+
+    def to(self, device):
+        self.module = self.module.to(device)
+        return self
+
+    def eval(self):
+        self.module.eval()
+        return self
+
+    def parameters(self):
+        return self.module.parameters()
+
+    def run(self, LR, c):
+        return self.module(LR, c)
+
+    def __call__(self, LR, c, eval=True):
+        if c.size(0) != LR.size(0):
+            c = c.expand(LR.size(0), -1)
+        outs = []
+        for begin in range(0, LR.size(0), self.batch_size):
+            lr, cond = LR[begin:begin + self.batch_size], c[begin:begin + self.batch_size]
+            num = lr.size(0)
+            if num < self.batch_size:
+                pad = self.batch_size - num
+                lr = torch.cat([lr, lr[-1:].expand(pad, -1, -1, -1)])
+                cond = torch.cat([cond, cond[-1:].expand(pad, -1)])
+            outs.append(self.run(lr.contiguous(), cond.contiguous())[:num])
+        return torch.cat(outs)
+
+
+@torch.no_grad()
+def export_netG(netG, path, batch_size=1, lr_size=64, cond_dim=512, device='cpu'):
+    """Trace NetG (including the frozen CLIP_Mapper layers) for fixed input shapes and save it.
+
+    The trace unrolls the GBlock chain and the prompt loop of CLIP_Mapper,
+    and torch.jit.freeze folds the weights and the stacked Affine
+    conditioning into constants. The input shapes are stored next to the
+    graph for load_exported.
+    """
+    graph = GeneratorGraph(netG).to(device).eval()
+    LR = torch.zeros(batch_size, 3, lr_size, lr_size, device=device)
+    c = torch.zeros(batch_size, cond_dim, device=device)
+    traced = torch.jit.trace(graph, (LR, c), check_trace=False)
+    frozen = torch.jit.freeze(traced)
+    meta = {'batch_size': batch_size, 'lr_size': lr_size, 'cond_dim': cond_dim}
+    torch.jit.save(frozen, path, _extra_files={'meta.json': json.dumps(meta)})
+    return frozen
+
+
+def load_exported(path, device='cpu'):
+    extra_files = {'meta.json': ''}
+    module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+    return ExportedNetG(module.eval(), json.loads(extra_files['meta.json']))
+
+
+@torch.no_grad()
+def export_onnx(netG, text_encoder, out_dir, batch_size=1, lr_size=64, cond_dim=512, context_length=77, opset=14, device='cpu'):
+    """Export NetG and CLIP_TXT_ENCODER as netG.onnx and text_encoder.onnx in out_dir.
+
+    NetG is exported for a fixed batch size (NetG resizes any LR size to
+    64x64), the text encoder with a dynamic batch axis. PixelShuffle maps to DepthToSpace, the Affine modulation to
+    Mul/Add and the CLIP ResidualAttentionBlocks to plain MatMul/Softmax
+    graphs. The input shapes go into meta.json for lib.onnx_backend.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    # newer torch defaults to the dynamo exporter, keep the TorchScript based one
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    graph = GeneratorGraph(netG).to(device).eval()
+    LR = torch.zeros(batch_size, 3, lr_size, lr_size, device=device)
+    c = torch.zeros(batch_size, cond_dim, device=device)
+    torch.onnx.export(graph, (LR, c), os.path.join(out_dir, 'netG.onnx'), input_names=['LR', 'c'],
+                      output_names=['SR'], dynamic_axes={'LR': {2: 'height', 3: 'width'}},
+                      opset_version=opset, do_constant_folding=True, **kwargs)
+    text_graph = TextGraph(text_encoder).to(device).eval()
+    tokens = torch.zeros(1, context_length, dtype=torch.long, device=device)
+    tokens[:, :2] = torch.tensor([49406, 49407])
+    torch.onnx.export(text_graph, (tokens,), os.path.join(out_dir, 'text_encoder.onnx'), input_names=['tokens'],
+                      output_names=['sent_emb'], dynamic_axes={'tokens': {0: 'batch'}, 'sent_emb': {0: 'batch'}},
+                      opset_version=opset, do_constant_folding=True, **kwargs)
+    meta = {'batch_size': batch_size, 'lr_size': lr_size, 'cond_dim': cond_dim, 'context_length': context_length}
+    with open(os.path.join(out_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
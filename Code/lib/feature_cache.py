@@ -0,0 +1,141 @@
+import os
+import hashlib
+from collections import OrderedDict
+
+import torch
+
+
+class FeatureCache:
+    """LRU cache of the frozen CLIP image features of real images.
+
+    Entries are keyed by the dataset sample key, which in shard mode carries the
+    crop/flip parameters. Up to max_size entries are kept in host memory, or as
+    files in cache_dir when it is given.
+
+    On disk every version (e.g. the CLIP model and dtype) and every rank gets
+    its own subdirectory, so features of another encoder are never read back
+    and DDP ranks never evict each other's files. The files left by an earlier
+    run are picked up again at start-up, the oldest beyond max_size removed.
+
+    The features of the misses are used on the device as they come out of the
+    encoder; their copy to the host is asynchronous and they are only added to
+    the cache on the next call.
+    """
+    def __init__(self, max_size, cache_dir=None, version='', rank=0):
+        self.max_size = max_size
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.pending = None
+        self.hits, self.misses = 0, 0
+        if cache_dir is not None:
+            version = hashlib.sha1(version.encode('utf-8')).hexdigest()[:16]
+            self.cache_dir = os.path.join(cache_dir, version, 'rank%d' % rank)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.load_index()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def name(self, key):
+        # the entries are keyed by file name on disk, so they can be rebuilt from the directory
+        if self.cache_dir is None:
+            return key
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.cache_dir, name + '.pth')
+
+    def load_index(self):
+        files = []
+        for filename in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, filename)
+            if filename.endswith('.pth'):
+                files.append((os.path.getmtime(path), filename[:-len('.pth')]))
+            else:
+                # a write that did not finish
+                self.remove(path)
+        for _, name in sorted(files):
+            self.entries[name] = None
+        self.evict()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        while len(self.entries) > self.max_size:
+            old_name, _ = self.entries.popitem(last=False)
+            if self.cache_dir is not None:
+                self.remove(self.path(old_name))
+
+    def get(self, key):
+        name = self.name(key)
+        if name not in self.entries:
+            return None
+        self.entries.move_to_end(name)
+        if self.cache_dir is None:
+            return self.entries[name]
+        try:
+            return torch.load(self.path(name))
+        except (OSError, EOFError, RuntimeError):
+            # removed or truncated behind our back, count it as a miss
+            del self.entries[name]
+            return None
+
+    def put(self, key, feats, emb):
+        name = self.name(key)
+        if self.cache_dir is None:
+            self.entries[name] = (feats, emb)
+        else:
+            tmp_path = '%s.%d.tmp' % (self.path(name), os.getpid())
+            torch.save((feats, emb), tmp_path)
+            os.replace(tmp_path, self.path(name))
+            self.entries[name] = None
+        self.entries.move_to_end(name)
+        self.evict()
+
+    def flush(self):
+        """Add the features of the last misses once their copy to the host has finished."""
+        if self.pending is None:
+            return
+        keys, feats, emb, done = self.pending
+        if done is not None:
+            done.synchronize()
+        for key, feat, e in zip(keys, feats, emb):
+            self.put(key, feat.clone(), e.clone())
+        self.pending = None
+
+    def __call__(self, image_encoder, imgs, keys):
+        # run the encoder only on the images that are not cached yet
+        self.flush()
+        cuda = imgs.device.type == 'cuda'
+        cached = [self.get(key) for key in keys]
+        hit = [idx for idx, entry in enumerate(cached) if entry is not None]
+        miss = [idx for idx, entry in enumerate(cached) if entry is None]
+        self.hits += len(hit)
+        self.misses += len(miss)
+        feats, emb = [], []
+        if len(hit) != 0:
+            for i, part in enumerate([feats, emb]):
+                host = torch.stack([cached[idx][i] for idx in hit])
+                if cuda:
+                    host = host.pin_memory()
+                part.append(host.to(imgs.device, non_blocking=True))
+        if len(miss) != 0:
+            with torch.no_grad():
+                miss_feats, miss_emb = image_encoder(imgs[miss])
+            feats.append(miss_feats)
+            emb.append(miss_emb)
+            if cuda:
+                host = [torch.empty(t.shape, dtype=t.dtype, pin_memory=True).copy_(t, non_blocking=True)
+                        for t in (miss_feats, miss_emb)]
+                done = torch.cuda.Event()
+                done.record()
+            else:
+                host, done = [miss_feats, miss_emb], None
+            self.pending = ([keys[idx] for idx in miss], host[0], host[1], done)
+        # back to the order of keys
+        order = torch.argsort(torch.tensor(hit + miss)).to(imgs.device)
+        return torch.cat(feats)[order], torch.cat(emb)[order]
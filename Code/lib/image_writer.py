@@ -0,0 +1,93 @@
+import os
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.utils import make_grid
+
+
+def to_uint8(imgs, value_range=(-1, 1)):
+    """Convert (B, C, H, W) or (C, H, W) images in value_range to uint8 on their device."""
+    low, high = value_range
+    imgs = (imgs.detach().float().clamp(low, high) - low) / (high - low)
+    return imgs.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+
+
+def to_uint8_grid(imgs, nrow=8, padding=2, value_range=(-1, 1)):
+    """Same layout and values as torchvision.utils.save_image(imgs, nrow=nrow, value_range=value_range, normalize=True)."""
+    low, high = value_range
+    imgs = (imgs.detach().float().clamp(low, high) - low) / (high - low)
+    grid = make_grid(imgs, nrow=nrow, padding=padding)
+    return grid.mul(255).add_(0.5).clamp_(0, 255).to(torch.uint8)
+
+
+class AsyncImageWriter:
+    """Encodes and writes images and caption files on a thread pool.
+
+    At most max_queue writes are pending at any time; submitting more blocks
+    the caller until a slot frees up. flush() waits for all pending writes and
+    re-raises the first error, close() also runs at interpreter exit.
+    """
+    def __init__(self, num_workers=4, max_queue=64):
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.BoundedSemaphore(max_queue)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.closed = False
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self.slots.release())
+        with self.lock:
+            self.futures = [f for f in self.futures if not f.done() or f.exception() is not None]
+            self.futures.append(future)
+        return future
+
+    def save_image(self, img, path):
+        # img: uint8 (C, H, W) tensor or (H, W, C) array, only the D2H copy happens here
+        if torch.is_tensor(img):
+            img = img.cpu().permute(1, 2, 0).numpy()
+        return self.submit(_write_image, np.ascontiguousarray(img), path)
+
+    def save_text(self, lines, path):
+        return self.submit(_write_text, list(lines), path)
+
+    def flush(self):
+        with self.lock:
+            futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        if self.closed:
+            return
+        self.flush()
+        self.pool.shutdown(wait=True)
+        self.closed = True
+        atexit.unregister(self.close)
+
+
+def _write_image(img, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    if img.shape[2] == 1:
+        img = img[:, :, 0]
+    Image.fromarray(img).save(path)
+
+
+def _write_text(lines, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        for line in lines:
+            f.write(line + '\n')
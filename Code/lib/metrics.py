@@ -0,0 +1,75 @@
+from collections import OrderedDict
+
+import torch
+import torch.distributed as dist
+
+
+class LossMeter:
+    """Running loss sums kept on the device, written to tensorboard every interval steps.
+
+    update() adds the detached losses to a device buffer without syncing.
+    Every interval steps step() averages the buffer over the steps (and over
+    the DDP ranks when distributed) and starts a non-blocking copy to the
+    host; the values are written out at the next interval, by which time the
+    copy has long finished, so logging never stalls the kernel queue.
+    values holds the last written averages, e.g. for the tqdm postfix.
+    """
+    def __init__(self, device, interval=20, writer=None, prefix='Loss/', distributed=False):
+        self.device = torch.device(device)
+        self.interval = max(int(interval), 1)
+        self.writer = writer
+        self.prefix = prefix
+        self.distributed = distributed
+        self.names = []
+        self.sums = None
+        self.count = 0
+        self.pending = None
+        self.values = OrderedDict()
+
+    def update(self, **losses):
+        """Accumulate losses (scalar tensors), the names must be the same every step."""
+        if self.sums is None:
+            self.names = list(losses.keys())
+            self.sums = torch.zeros(len(self.names), device=self.device)
+        self.sums.add_(torch.stack([losses[name].detach().float() for name in self.names]))
+        self.count += 1
+
+    def step(self, global_step):
+        if self.count < self.interval:
+            return
+        self.write()
+        means = self.sums / self.count
+        if self.distributed:
+            dist.all_reduce(means)
+            means /= dist.get_world_size()
+        if self.device.type == 'cuda':
+            host = torch.empty(means.shape, dtype=means.dtype, pin_memory=True)
+            host.copy_(means, non_blocking=True)
+            done = torch.cuda.Event()
+            done.record()
+        else:
+            host, done = means, None
+        self.pending = (host, done, global_step)
+        self.sums.zero_()
+        self.count = 0
+
+    def write(self):
+        """Write the averages of the last finished interval."""
+        if self.pending is None:
+            return
+        host, done, global_step = self.pending
+        if done is not None:
+            done.synchronize()
+        self.values = OrderedDict(zip(self.names, host.tolist()))
+        if self.writer is not None:
+            for name, value in self.values.items():
+                self.writer.add_scalar(self.prefix + name, value, global_step)
+        self.pending = None
+
+    def close(self, global_step=None):
+        """Flush the partial interval and everything still pending."""
+        if self.count > 0 and global_step is not None:
+            self.interval, interval = self.count, self.interval
+            self.step(global_step)
+            self.interval = interval
+        self.write()
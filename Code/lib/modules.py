@@ -1,4 +1,5 @@
 import os, sys
+import contextlib
 from pyexpat import features
 import math
 import os.path as osp
@@ -16,12 +17,18 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 import torch.backends.cudnn as cudnn
+import clip
 import torchvision.transforms as transforms
 import torchvision.utils as vutils
 from torchvision.utils import make_grid
 from lib.utils import transf_to_CLIP_input, dummy_context_mgr
-from lib.utils import mkdir_p, get_rank,perceptual_loss
+from lib.utils import mkdir_p, get_rank, PerceptualLoss
 from lib.datasets import prepare_data
+from lib.psnr_ssim import PSNR_SSIM_Meter
+from lib.perpare import LazyCLIP
+from lib.image_writer import AsyncImageWriter, to_uint8, to_uint8_grid
+from lib.profiler import StepProfiler
+from lib.metrics import LossMeter
 
 from models.inception import InceptionV3
 from torch.nn.functional import adaptive_avg_pool2d
@@ -32,7 +39,7 @@ from lib.niqe import calculate_niqe
 
 from torch.utils.tensorboard import SummaryWriter
 
-def train(dataloader, netG, netD, netC, text_encoder, image_encoder, optimizerG, optimizerD, scaler_G, scaler_D, writer, args):
+def train(dataloader, netG, netD, netC, text_encoder, image_encoder, optimizerG, optimizerD, scaler_G, scaler_D, writer, args, feat_cache=None, percep_loss=None, profiler=None, magp=None):
     batch_size = args.batch_size
     device = args.device
     epoch = args.current_epoch
@@ -40,109 +47,181 @@ def train(dataloader, netG, netD, netC, text_encoder, image_encoder, optimizerG,
     z_dim = args.z_dim
 
     netG, netD, netC, image_encoder = netG.train(), netD.train(), netC.train(), image_encoder.train()
+    if percep_loss is None:
+        percep_loss = PerceptualLoss().to(device)
+    if profiler is None:
+        profiler = StepProfiler(enabled=False)
+    phase = profiler.phase
+    # the losses stay on the device and are only read every log_interval steps
+    meter = LossMeter(device, args.log_interval, writer, distributed=args.multi_gpus)
+    # pass the same MAGP every epoch, it counts the D updates for the lazy schedule
+    if magp is None:
+        magp = MAGP(args.magp_interval, args.mixed_precision)
+
+    # each D and G update sums the gradients of grad_accum_steps micro-batches
+    accum = max(int(args.grad_accum_steps), 1)
+    models = [netG, netD, netC]
 
     if (args.multi_gpus == True) and (get_rank() != 0):
         None
     else:
         loop = tqdm(total=len(dataloader))
 
-    for step, data in enumerate(dataloader, 0):
+    micro_batches = []
+    global_step = epoch * len(dataloader)
+    for step, data in enumerate(profiler.iterate(dataloader), 0):
+        micro_batches.append(data)
+        if len(micro_batches) < accum and step != len(dataloader) - 1:
+            continue
         global_step = epoch * len(dataloader) + step
+        profiler.begin(global_step)
+        # the real features and sentence embeddings only need gradients for the MA-GP
+        regularize = magp.required()
+        num = len(micro_batches)
+        # with several micro-batches the fakes are generated again in the G step, so the D step
+        # does not hold on to their graphs
+        keep_fake = num == 1
+        kept, D_losses = [], []
 
         ##############
         # Train D
         ##############
         optimizerD.zero_grad()
-        with torch.cuda.amp.autocast() if args.mixed_precision else dummy_context_mgr() as mpc:
-            real, LR, captions, CLIP_tokens, sent_emb, words_embs, keys = prepare_data(data, text_encoder, device)
-            real = real.requires_grad_()
-            sent_emb = sent_emb.requires_grad_()
-            words_embs = words_embs.requires_grad_()
-
-            CLIP_real, real_emb = image_encoder(real)
-            real_feats = netD(CLIP_real)
-            pred_real, errD_real = predict_loss(netC, real_feats, sent_emb, negtive=False)
-
-            mis_sent_emb = torch.cat((sent_emb[1:], sent_emb[0:1]), dim=0).detach()
-            _, errD_mis = predict_loss(netC, real_feats, mis_sent_emb, negtive=True)
-
-            fake = netG(LR, sent_emb)
-            CLIP_fake, fake_emb = image_encoder(fake)
-            fake_feats = netD(CLIP_fake.detach())
-            _, errD_fake = predict_loss(netC, fake_feats, sent_emb, negtive=True)
-
-        if args.mixed_precision:
-            errD_MAGP = MA_GP_MP(CLIP_real, sent_emb, pred_real, scaler_D)
-        else:
-            errD_MAGP = MA_GP_FP32(CLIP_real, sent_emb, pred_real)
-
-        with torch.cuda.amp.autocast() if args.mixed_precision else dummy_context_mgr() as mpc:
-            errD = errD_real + (errD_fake + errD_mis) / 2.0 + errD_MAGP
-
-        writer.add_scalar('Loss/errD_real', errD_real.item(), global_step)
-        writer.add_scalar('Loss/errD_fake', errD_fake.item(), global_step)
-        writer.add_scalar('Loss/errD_mis', errD_mis.item(), global_step)
-        writer.add_scalar('Loss/errD_MAGP', errD_MAGP.item(), global_step)
-        writer.add_scalar('Loss/errD_total', errD.item(), global_step)
-
-        if args.mixed_precision:
-            scaler_D.scale(errD).backward()
-            scaler_D.step(optimizerD)
-            scaler_D.update()
-            if scaler_D.get_scale() < args.scaler_min:
-                scaler_D.update(16384.0)
-        else:
-            errD.backward()
-            optimizerD.step()
+        for idx, data in enumerate(micro_batches):
+            with no_sync(models, idx != num - 1):
+                with torch.cuda.amp.autocast() if args.mixed_precision else dummy_context_mgr() as mpc:
+                    with phase('prepare_data'):
+                        real, LR, captions, CLIP_tokens, sent_emb, words_embs, keys = prepare_data(data, text_encoder, device)
+                        if regularize:
+                            sent_emb = sent_emb.requires_grad_()
+
+                    with phase('clip_encoder'):
+                        if feat_cache is not None:
+                            CLIP_real, real_emb = feat_cache(image_encoder, real, keys)
+                        else:
+                            CLIP_real, real_emb = image_encoder(real)
+                        if regularize:
+                            CLIP_real = CLIP_real.detach().requires_grad_()
+                    with phase('D_forward'):
+                        real_feats = netD(CLIP_real)
+                        pred_real, errD_real = predict_loss(netC, real_feats, sent_emb, negtive=False)
+
+                        # the mismatched captions are drawn within the micro-batch
+                        mis_sent_emb = torch.cat((sent_emb[1:], sent_emb[0:1]), dim=0).detach()
+                        _, errD_mis = predict_loss(netC, real_feats, mis_sent_emb, negtive=True)
+
+                    with dummy_context_mgr() if keep_fake else torch.no_grad():
+                        with phase('G_forward'):
+                            fake = netG(LR, sent_emb)
+                        with phase('clip_encoder'):
+                            CLIP_fake, fake_emb = image_encoder(fake)
+                    with phase('D_forward'):
+                        fake_feats = netD(CLIP_fake.detach())
+                        _, errD_fake = predict_loss(netC, fake_feats, sent_emb, negtive=True)
+
+                with phase('MAGP') if regularize else dummy_context_mgr():
+                    errD_MAGP = magp(CLIP_real, sent_emb, pred_real, scaler_D)
+
+                with torch.cuda.amp.autocast() if args.mixed_precision else dummy_context_mgr() as mpc:
+                    errD = errD_real + (errD_fake + errD_mis) / 2.0 + errD_MAGP
+
+                with phase('D_backward'):
+                    if args.mixed_precision:
+                        scaler_D.scale(errD / num).backward()
+                    else:
+                        (errD / num).backward()
+            D_losses.append(dict(errD_real=errD_real, errD_fake=errD_fake, errD_mis=errD_mis, errD_MAGP=errD_MAGP, errD_total=errD))
+            if keep_fake:
+                kept.append((real, LR, sent_emb, fake, CLIP_fake, fake_emb))
+            else:
+                kept.append((real, LR, sent_emb, None, None, None))
+
+        with phase('D_backward'):
+            if args.mixed_precision:
+                scaler_D.step(optimizerD)
+                scaler_D.update()
+                if scaler_D.get_scale() < args.scaler_min:
+                    scaler_D.update(16384.0)
+            else:
+                optimizerD.step()
+        magp.step()
 
         ##############
         # Train G
         ##############
         optimizerG.zero_grad()
+        for idx, (real, LR, sent_emb, fake, CLIP_fake, fake_emb) in enumerate(kept):
+            with no_sync(models, idx != num - 1):
+                with torch.cuda.amp.autocast() if args.mixed_precision else dummy_context_mgr() as mpc:
+                    if fake is None:
+                        with phase('G_forward'):
+                            fake = netG(LR, sent_emb)
+                        with phase('clip_encoder'):
+                            CLIP_fake, fake_emb = image_encoder(fake)
+                    with phase('G_loss'):
+                        fake_feats = netD(CLIP_fake)
+                        output = netC(fake_feats, sent_emb)
+                        text_img_sim = torch.cosine_similarity(fake_emb, sent_emb).mean()
+                        g_errG = -output.mean() - args.sim_w * text_img_sim
+                        loss_func = nn.L1Loss().to(device)
+                    with phase('vgg'):
+                        loss_per = percep_loss(fake, real)
+                    loss_1 = loss_func(fake, real)
+
+                    a = 0.01
+                    errG = loss_1 + a * g_errG + loss_per
+
+                with phase('G_backward'):
+                    if args.mixed_precision:
+                        scaler_G.scale(errG / num).backward()
+                    else:
+                        (errG / num).backward()
+            with phase('log', host=True):
+                meter.update(errG_total=errG, loss_1=loss_1, g_errG=g_errG, loss_perceptual=loss_per, **D_losses[idx])
+
+        with phase('G_backward'):
+            if args.mixed_precision:
+                scaler_G.step(optimizerG)
+                scaler_G.update()
+                if scaler_G.get_scale() < args.scaler_min:
+                    scaler_G.update(16384.0)
+            else:
+                optimizerG.step()
 
-        with torch.cuda.amp.autocast() if args.mixed_precision else dummy_context_mgr() as mpc:
-            fake_feats = netD(CLIP_fake)
-            output = netC(fake_feats, sent_emb)
-            text_img_sim = torch.cosine_similarity(fake_emb, sent_emb).mean()
-            g_errG = -output.mean() - args.sim_w * text_img_sim
-            loss_func = nn.L1Loss().to(device)
-            loss_per = perceptual_loss(fake, real).to(device)
-            loss_1 = loss_func(fake, real)
-
-            a = 0.01
-            errG = loss_1 + a * g_errG + loss_per
-
-        writer.add_scalar('Loss/errG_total', errG.item(), global_step)
-        writer.add_scalar('Loss/loss_1', loss_1.item(), global_step)
-        writer.add_scalar('Loss/g_errG', g_errG.item(), global_step)
-        writer.add_scalar('Loss/loss_perceptual', loss_per.item(), global_step)
-
-        if args.mixed_precision:
-            scaler_G.scale(errG).backward()
-            scaler_G.step(optimizerG)
-            scaler_G.update()
-            if scaler_G.get_scale() < args.scaler_min:
-                scaler_G.update(16384.0)
-        else:
-            errG.backward()
-            optimizerG.step()
+        with phase('log', host=True):
+            meter.step(global_step)
 
         if (args.multi_gpus == True) and (get_rank() != 0):
             None
         else:
-            loop.update(1)
+            loop.update(num)
             loop.set_description(f'Train Epoch [{epoch}/{max_epoch}]')
-            loop.set_postfix(errD=errD.item(), errG=errG.item())
+            if meter.values:
+                loop.set_postfix(errD=meter.values['errD_total'], errG=meter.values['errG_total'])
+        profiler.step(global_step)
+        micro_batches, kept = [], []
 
+    meter.close(global_step)
     if (args.multi_gpus == True) and (get_rank() != 0):
         None
     else:
         loop.close()
 
 
-def test(dataloader,text_encoder, netG,img_save_dir, PTM, device, epoch, max_epoch, times, z_dim, batch_size):
-    PSNR = calculate_PSNR(dataloader, text_encoder, netG,img_save_dir, PTM, device,epoch, max_epoch, times, z_dim, batch_size)
-    return PSNR
+def no_sync(models, enabled):
+    # skip the DDP gradient all-reduce for all but the last micro-batch of an update
+    stack = contextlib.ExitStack()
+    if enabled:
+        for model in models:
+            if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+                stack.enter_context(model.no_sync())
+    return stack
+
+
+def test(dataloader,text_encoder, netG,img_save_dir, PTM, device, epoch, max_epoch, times, z_dim, batch_size, crop_border=0, test_y_channel=False):
+    # PTM is the CLIP model for the CLIP score, None skips it
+    PSNR, CLIP_score = calculate_PSNR(dataloader, text_encoder, netG,img_save_dir, PTM, device,epoch, max_epoch, times, z_dim, batch_size, crop_border, test_y_channel)
+    return PSNR, CLIP_score
 
 
 
@@ -158,6 +237,7 @@ def save_model(netG, netD, netC, optG, optD, epoch, multi_gpus, step, save_path)
 
 #########   MAGP   ########
 def MA_GP_MP(img, sent, out, scaler):
+    # the gradients of the scaled output, unscaled inside the norm
     grads = torch.autograd.grad(outputs=scaler.scale(out),
                             inputs=(img, sent),
                             grad_outputs=torch.ones_like(out),
@@ -165,34 +245,65 @@ def MA_GP_MP(img, sent, out, scaler):
                             create_graph=True,
                             only_inputs=True)
     inv_scale = 1./(scaler.get_scale()+float("1e-8"))
-    #inv_scale = 1./scaler.get_scale()
-    grads = [grad * inv_scale for grad in grads]
-    with torch.cuda.amp.autocast():
-        grad0 = grads[0].view(grads[0].size(0), -1)
-        grad1 = grads[1].view(grads[1].size(0), -1)
-        grad = torch.cat((grad0,grad1),dim=1)                        
-        grad_l2norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
-        d_loss_gp =  2.0 * torch.mean((grad_l2norm) ** 6)
-    return d_loss_gp
+    return ma_gp_from_grads(grads, inv_scale)
 
 
 def MA_GP_FP32(img, sent, out):
     grads = torch.autograd.grad(outputs=out,
                             inputs=(img, sent),
-                            grad_outputs=torch.ones(out.size()).cuda(),
+                            grad_outputs=torch.ones_like(out),
                             retain_graph=True,
                             create_graph=True,
                             only_inputs=True)
-    grad0 = grads[0].view(grads[0].size(0), -1)
-    grad1 = grads[1].view(grads[1].size(0), -1)
-    grad = torch.cat((grad0,grad1),dim=1)                        
-    grad_l2norm = torch.sqrt(torch.sum(grad ** 2, dim=1))
-    d_loss_gp =  2.0 * torch.mean((grad_l2norm) ** 6)
-    return d_loss_gp
+    return ma_gp_from_grads(grads)
+
+
+def ma_gp_from_grads(grads, scale=1.):
+    # 2 * mean(||(grad_img, grad_sent)||^6) from the per-sample squared norms, without concatenating the gradients
+    sq_norm = sum(grad.float().flatten(1).pow(2).sum(dim=1) for grad in grads)
+    if scale != 1.:
+        sq_norm = sq_norm * (scale * scale)
+    return 2.0 * torch.mean(sq_norm ** 3)
+
+
+class MAGP:
+    """MA-GP with optional lazy regularization.
+
+    With interval k the penalty is only computed on every k-th D step and
+    its weight is multiplied by k, as in StyleGAN2; the other steps skip the
+    double backward through NetD/NetC. The D updates are counted by step(),
+    which the training loop calls after each optimizer step, so the schedule
+    does not depend on the epoch length. required() tells the training loop
+    whether the real features need gradients in the current update.
+    """
+    def __init__(self, interval=1, mixed_precision=False):
+        self.interval = max(int(interval), 1)
+        self.mixed_precision = mixed_precision
+        self.updates = 0
+        self.computed, self.skipped = 0, 0
+
+    def required(self):
+        return self.updates % self.interval == 0
+
+    def step(self):
+        self.updates += 1
+
+    def __call__(self, img, sent, out, scaler=None):
+        if not self.required():
+            self.skipped += 1
+            return out.new_zeros((), dtype=torch.float32)
+        self.computed += 1
+        if self.mixed_precision:
+            penalty = MA_GP_MP(img, sent, out, scaler)
+        else:
+            penalty = MA_GP_FP32(img, sent, out)
+        return penalty * self.interval
 
 
-def sample(dataloader, netG, text_encoder, save_dir, device, multi_gpus, z_dim, stamp):
+def sample(dataloader, netG, text_encoder, save_dir, device, multi_gpus, z_dim, stamp, writer_workers=4, writer_queue=64):
+    # writer_workers/writer_queue are the config keys of the same name
     netG.eval()
+    img_writer = AsyncImageWriter(writer_workers, writer_queue)
     for step, data in enumerate(dataloader, 0):
         ######################################################
         # (1) Prepare_data
@@ -220,48 +331,41 @@ def sample(dataloader, netG, text_encoder, save_dir, device, multi_gpus, z_dim,
                 batch_txt_name = 'step_%04d.txt'%(step)
                 batch_txt_save_dir  = osp.join(save_dir, 'batch', 'txts')
                 batch_txt_save_name = osp.join(batch_txt_save_dir, batch_txt_name)
-            mkdir_p(batch_img_save_dir)
-            vutils.save_image(fake_imgs.data, batch_img_save_name, nrow=8, value_range=(-1, 1), normalize=True)
-            mkdir_p(batch_txt_save_dir)
-            txt = open(batch_txt_save_name,'w')
-            for cap in captions:
-                txt.write(cap+'\n')
-            txt.close()
+            img_writer.save_image(to_uint8_grid(fake_imgs.data, nrow=8), batch_img_save_name)
+            img_writer.save_text(captions, batch_txt_save_name)
+            ims = to_uint8(fake_imgs.data).cpu()
             for j in range(batch_size):
-                im = fake_imgs[j].data.cpu().numpy()
-                im = (im + 1.0) * 127.5
-                im = im.astype(np.uint8)
-                im = np.transpose(im, (1, 2, 0))
-                im = Image.fromarray(im)
                 ######################################################
                 # (3) Save fake images
                 ######################################################      
+                single_img_name = 'batch_%04d.png'%(j)
                 if multi_gpus==True:
-                    single_img_name = 'batch_%04d.png'%(j)
                     single_img_save_dir  = osp.join(save_dir, 'single', str('gpu%d'%(get_rank())), 'step%04d'%(step))
-                    single_img_save_name = osp.join(single_img_save_dir, single_img_name)
                 else:
-                    single_img_name = 'step_%04d.png'%(step)
                     single_img_save_dir  = osp.join(save_dir, 'single', 'step%04d'%(step))
-                    single_img_save_name = osp.join(single_img_save_dir, single_img_name)   
-                mkdir_p(single_img_save_dir)   
-                im.save(single_img_save_name)
+                single_img_save_name = osp.join(single_img_save_dir, single_img_name)
+                img_writer.save_image(ims[j], single_img_save_name)
         if (multi_gpus==True) and (get_rank() != 0):
             None
         else:
             print('Step: %d' % (step))
+    img_writer.close()
 
 def calculate_PSNR(
         dataloader, text_encoder, netG,save_dir, CLIP, device,  epoch,
-          max_epoch, times, z_dim, batch_size):
+          max_epoch, times, z_dim, batch_size, crop_border=0, test_y_channel=False):
 
     n_gpu=1
     dl_length = dataloader.__len__()
     imgs_num = dl_length * 1 * batch_size * times
     loop = tqdm(total=int(dl_length*times))
+    # validation only reports PSNR, so the SSIM convolutions are skipped
+    meter = PSNR_SSIM_Meter(crop_border, test_y_channel, ssim=False)
+    if isinstance(CLIP, LazyCLIP):
+        CLIP = CLIP.model
+    clip_sim, clip_num = 0., 0
 
     for time in range(times):
-        avg_psnr = 0.
         idx=0
         for i, data in enumerate(dataloader):
             idx += 1
@@ -283,27 +387,40 @@ def calculate_PSNR(
                     # (3) Save fake images
                     ######################################################      
                 #---------------------------------
-                avg_psnr+=calculate_psnr(tensor2img(SR),tensor2img(HR))
+                meter.update(SR, HR)
+                if CLIP is not None:
+                    if CLIP_tokens is None:
+                        CLIP_tokens = clip.tokenize(list(captions), truncate=True).to(device)
+                    clip_sim = clip_sim + calc_clip_sim(CLIP, SR, CLIP_tokens, device).float() * SR.size(0)
+                    clip_num += SR.size(0)
                 loop.update(1)
                 if epoch==-1:
                     loop.set_description('Evaluating]')
                 else:
                     loop.set_description(f'Eval Epoch [{epoch}/{max_epoch}]')
                     loop.set_postfix()
-        avg_psnr = avg_psnr / idx
-    return avg_psnr
+    loop.close()
+    avg_psnr, _ = meter.result()
+    CLIP_score = float(clip_sim) / clip_num if clip_num != 0 else None
+    return avg_psnr, CLIP_score
+
 
 def calculate_PSNRs(
         dataloader, text_encoder, netG,save_dir, CLIP, device,  epoch,
-          max_epoch, times, z_dim, batch_size):
+          max_epoch, times, z_dim, batch_size, crop_border=0, test_y_channel=False, img_writer=None,
+          writer_workers=4, writer_queue=64):
 
     n_gpu=1
     dl_length = dataloader.__len__()
     imgs_num = dl_length * 1 * batch_size * times
     loop = tqdm(total=int(dl_length*times))
+    # validation only reports PSNR, so the SSIM convolutions are skipped
+    meter = PSNR_SSIM_Meter(crop_border, test_y_channel, ssim=False)
+    own_writer = img_writer is None
+    if own_writer:
+        img_writer = AsyncImageWriter(writer_workers, writer_queue)
 
     for time in range(times):
-        avg_psnr = 0.
         idx=0
         for i, data in enumerate(dataloader):
             idx += 1
@@ -328,70 +445,33 @@ def calculate_PSNRs(
                 batch_txt_name = 'step_%04d.txt'%(i)
                 batch_txt_save_dir  = osp.join(save_dir, 'batch', 'txts')
                 batch_txt_save_name = osp.join(batch_txt_save_dir, batch_txt_name)
-                mkdir_p(batch_img_save_dir)
-                vutils.save_image(fake_imgs.data, batch_img_save_name, nrow=8, value_range=(-1, 1), normalize=True)
-                mkdir_p(batch_txt_save_dir)
-                txt = open(batch_txt_save_name,'w')
-                for cap in captions:
-                    txt.write(cap+'\n')
-                txt.close()
+                img_writer.save_image(to_uint8_grid(fake_imgs.data, nrow=8), batch_img_save_name)
+                img_writer.save_text(captions, batch_txt_save_name)
+                ims = to_uint8(fake_imgs.data).cpu()
                 for j in range(batch_size):
-                    im = fake_imgs[j].data.cpu().numpy()
-                    im = (im + 1.0) * 127.5
-                    im = im.astype(np.uint8)
-                    im = np.transpose(im, (1, 2, 0))
-                    im = Image.fromarray(im)
                     ######################################################
                     # (3) Save fake images
                     ######################################################      
-                    single_img_name = 'step_%04d.png'%(i)
+                    single_img_name = 'batch_%04d.png'%(j)
                     single_img_save_dir  = osp.join(save_dir, 'single', 'step%04d'%(i))
                     single_img_save_name = osp.join(single_img_save_dir, single_img_name)   
-                    mkdir_p(single_img_save_dir)   
-                    im.save(single_img_save_name)
+                    img_writer.save_image(ims[j], single_img_save_name)
 
                 #---------------------------------
-                avg_psnr+=calculate_psnr(tensor2img(fake_imgs),tensor2img(imgs))
+                meter.update(fake_imgs, imgs)
                 loop.update(1)
                 if epoch==-1:
                     loop.set_description('Evaluating]')
                 else:
                     loop.set_description(f'Eval Epoch [{epoch}/{max_epoch}]')
                     loop.set_postfix()
-        avg_psnr = avg_psnr / idx
-    return avg_psnr
-
-def tensor2img(tensor, out_type=np.uint8, min_max=(-1, 1)):
-    tensor = tensor.squeeze().float().cpu().clamp_(*min_max)  # clamp
-    tensor = (tensor - min_max[0]) / \
-        (min_max[1] - min_max[0])  # to range [0,1]
-    n_dim = tensor.dim()
-    if n_dim == 4:
-        n_img = len(tensor)
-        img_np = make_grid(tensor, nrow=int(
-            math.sqrt(n_img)), normalize=False).detach().numpy()
-        img_np = np.transpose(img_np, (1, 2, 0))  # HWC, RGB
-    elif n_dim == 3:
-        img_np = tensor.detach().numpy()
-        img_np = np.transpose(img_np, (1, 2, 0))  # HWC, RGB
-    elif n_dim == 2:
-        img_np = tensor.numpy()
+    loop.close()
+    if own_writer:
+        img_writer.close()
     else:
-        raise TypeError(
-            'Only support 4D, 3D and 2D tensor. But received with dimension: {:d}'.format(n_dim))
-    if out_type == np.uint8:
-        img_np = (img_np * 255.0).round()
-
-    return img_np.astype(out_type)
-
-def calculate_psnr(img1, img2):
-    # img1 and img2 have range [0, 255]
-    img1 = img1.astype(np.float64)
-    img2 = img2.astype(np.float64)
-    mse = np.mean((img1 - img2)**2)
-    if mse == 0:
-        return float('inf')
-    return 20 * math.log10(255.0 / math.sqrt(mse))
+        img_writer.flush()
+    avg_psnr, _ = meter.result()
+    return avg_psnr
 
 def calc_clip_sim(clip, fake, caps_clip, device):
     fake = transf_to_CLIP_input(fake)
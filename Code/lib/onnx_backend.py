@@ -0,0 +1,101 @@
+import os
+import json
+import importlib.util
+
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
+
+
+def load_clip_tokenizer():
+    # load clip/simple_tokenizer.py on its own, importing the clip package would import torch
+    spec = importlib.util.find_spec('clip')
+    path = os.path.join(spec.submodule_search_locations[0], 'simple_tokenizer.py')
+    module_spec = importlib.util.spec_from_file_location('clip_simple_tokenizer', path)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    return module.SimpleTokenizer()
+
+
+class OnnxSRBackend:
+    """Text-guided SR with the graphs from lib.export.export_onnx on onnxruntime.
+
+    Needs numpy, onnxruntime, Pillow and the CLIP tokenizer files, but not
+    PyTorch. Same inputs and outputs as CLIPSRPipeline: LR images as uint8
+    HWC arrays, PIL images or a float (B, 3, h, w) array in [-1, 1].
+    """
+    def __init__(self, model_dir, num_threads=0, providers=('CPUExecutionProvider',)):
+        with open(os.path.join(model_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.batch_size = self.meta['batch_size']
+        self.context_length = self.meta['context_length']
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.netG = ort.InferenceSession(os.path.join(model_dir, 'netG.onnx'), options, providers=list(providers))
+        self.text_encoder = ort.InferenceSession(os.path.join(model_dir, 'text_encoder.onnx'), options, providers=list(providers))
+        self.tokenizer = load_clip_tokenizer()
+        self.sot = self.tokenizer.encoder['<|startoftext|>']
+        self.eot = self.tokenizer.encoder['<|endoftext|>']
+
+    def tokenize(self, captions):
+        # same as clip.tokenize(captions, truncate=True)
+        tokens = np.zeros((len(captions), self.context_length), dtype=np.int64)
+        for i, caption in enumerate(captions):
+            ids = [self.sot] + self.tokenizer.encode(caption) + [self.eot]
+            if len(ids) > self.context_length:
+                ids = ids[:self.context_length]
+                ids[-1] = self.eot
+            tokens[i, :len(ids)] = ids
+        return tokens
+
+    def encode_text(self, captions):
+        return self.text_encoder.run(['sent_emb'], {'tokens': self.tokenize(captions)})[0]
+
+    def preprocess(self, images):
+        if isinstance(images, np.ndarray) and images.dtype != np.uint8:
+            imgs = images.astype(np.float32)
+        else:
+            imgs = []
+            for img in images:
+                if isinstance(img, Image.Image):
+                    img = np.asarray(img.convert('RGB'))
+                imgs.append(np.asarray(img).transpose(2, 0, 1))
+            imgs = np.stack(imgs).astype(np.float32) / 127.5 - 1.
+        if imgs.ndim == 3:
+            imgs = imgs[None]
+        return np.ascontiguousarray(imgs)
+
+    def generate(self, LR, c):
+        # the generator graph has a fixed batch size, pad the last chunk with its final sample
+        outs = []
+        for begin in range(0, LR.shape[0], self.batch_size):
+            lr, cond = LR[begin:begin + self.batch_size], c[begin:begin + self.batch_size]
+            num = lr.shape[0]
+            if num < self.batch_size:
+                pad = self.batch_size - num
+                lr = np.concatenate([lr, np.repeat(lr[-1:], pad, 0)])
+                cond = np.concatenate([cond, np.repeat(cond[-1:], pad, 0)])
+            outs.append(self.netG.run(['SR'], {'LR': lr, 'c': cond})[0][:num])
+        return np.concatenate(outs)
+
+    def __call__(self, images, captions, output_type='array'):
+        """Super-resolve a batch of LR images, one caption per image.
+
+        output_type 'array' returns float32 (B, 3, H, W) in [-1, 1], 'uint8'
+        uint8 (B, H, W, 3) and 'pil' a list of PIL images.
+        """
+        if isinstance(captions, str):
+            captions = [captions]
+        LR = self.preprocess(images)
+        if LR.shape[0] != len(captions):
+            raise ValueError('Got %d images but %d captions.' % (LR.shape[0], len(captions)))
+        SR = self.generate(LR, self.encode_text(captions))
+        if output_type == 'array':
+            return SR
+        SR = ((np.clip(SR, -1., 1.) + 1.) * 127.5 + 0.5).astype(np.uint8).transpose(0, 2, 3, 1)
+        if output_type == 'uint8':
+            return SR
+        if output_type == 'pil':
+            return [Image.fromarray(img) for img in SR]
+        raise ValueError('Unknown output_type: %s' % (output_type))
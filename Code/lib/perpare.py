@@ -12,17 +12,112 @@ from torch.utils.data import DataLoader, random_split
 from torch.utils.data.distributed import DistributedSampler
 import clip
 import importlib
-from lib.utils import choose_model
+from lib.utils import choose_model, PerceptualLoss
 import torch.nn.functional as F
 import torchvision.transforms as transforms
 
 
 ###########   preparation   ############
-def load_clip(clip_info, device):
+CLIP_DTYPES = {
+    'float32': torch.float32, 'fp32': torch.float32,
+    'float16': torch.float16, 'fp16': torch.float16,
+    'bfloat16': torch.bfloat16, 'bf16': torch.bfloat16,
+    }
+
+
+def clip_dtype(name, device):
+    """Storage dtype of the frozen CLIP towers.
+
+    'auto' keeps what clip.load picks: fp16 on CUDA, fp32 on CPU. fp16 falls
+    back to fp32 on CPU.
+    """
+    device = torch.device(device)
+    if name in (None, '', 'auto'):
+        return torch.float16 if device.type == 'cuda' else torch.float32
+    dtype = name if isinstance(name, torch.dtype) else CLIP_DTYPES[name]
+    if dtype == torch.float16 and device.type != 'cuda':
+        print('fp16 CLIP weights need CUDA, using fp32 on %s' % (device))
+        return torch.float32
+    return dtype
+
+
+def set_clip_precision(model, dtype):
+    """Store the CLIP weights in dtype, in place.
+
+    Convs, Linears, attention projections and the embeddings are converted,
+    so the encoders only cast at their inputs and outputs. The LayerNorms
+    stay fp32, CLIP computes them in fp32 anyway.
+    """
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, (torch.nn.Conv2d, torch.nn.Linear, torch.nn.Embedding)):
+                module.weight.data = module.weight.data.to(dtype)
+                if getattr(module, 'bias', None) is not None:
+                    module.bias.data = module.bias.data.to(dtype)
+            if isinstance(module, torch.nn.MultiheadAttention):
+                for name in ['in_proj_weight', 'in_proj_bias', 'q_proj_weight', 'k_proj_weight', 'v_proj_weight', 'bias_k', 'bias_v']:
+                    tensor = getattr(module, name)
+                    if tensor is not None:
+                        tensor.data = tensor.data.to(dtype)
+            for name in ['text_projection', 'proj', 'class_embedding', 'positional_embedding']:
+                tensor = getattr(module, name, None)
+                if isinstance(tensor, torch.nn.Parameter):
+                    tensor.data = tensor.data.to(dtype)
+    return model
+
+
+def load_clip(clip_info, device, dtype='auto'):
     import clip as clip
-    print(type)
     model = clip.load(clip_info['type'], device=device)[0]
-    return model
+    return set_clip_precision(model, clip_dtype(dtype, device))
+
+
+class CLIPRegistry:
+    """Loads each CLIP model once per (type, device, dtype) and hands out the same instance.
+
+    The models are frozen, so everything built on the same key shares one
+    copy of the weights.
+    """
+    def __init__(self):
+        self.models = {}
+
+    def key(self, clip_info, device, dtype='auto'):
+        device = torch.device(device)
+        if device.type == 'cuda' and device.index is None:
+            device = torch.device('cuda', torch.cuda.current_device())
+        return (clip_info['type'], str(device), clip_dtype(dtype, device))
+
+    def loaded(self, clip_info, device, dtype='auto'):
+        return self.key(clip_info, device, dtype) in self.models
+
+    def get(self, clip_info, device, dtype='auto'):
+        key = self.key(clip_info, device, dtype)
+        if key not in self.models:
+            self.models[key] = load_clip(clip_info, device, key[2]).eval()
+        return self.models[key]
+
+    def lazy(self, clip_info, device, dtype='auto'):
+        return LazyCLIP(self, clip_info, device, dtype)
+
+
+class LazyCLIP:
+    """A CLIP model from a CLIPRegistry that is only loaded on first use of .model."""
+    def __init__(self, registry, clip_info, device, dtype='auto'):
+        self.registry = registry
+        self.clip_info = clip_info
+        self.device = device
+        self.dtype = dtype
+
+    @property
+    def loaded(self):
+        return self.registry.loaded(self.clip_info, self.device, self.dtype)
+
+    @property
+    def model(self):
+        return self.registry.get(self.clip_info, self.device, self.dtype)
+
+
+clip_registry = CLIPRegistry()
 
 
 def prepare_models(args):
@@ -30,9 +125,9 @@ def prepare_models(args):
     local_rank = args.local_rank
     multi_gpus = args.multi_gpus
 
-    CLIP4trn = load_clip(args.clip4trn, device).eval()
- 
-    CLIP4evl = load_clip(args.clip4evl, device).eval()
+    CLIP4trn = clip_registry.get(args.clip4trn, device, args.clip_dtype)
+    # only loaded when a metric asks for it, and the same model as CLIP4trn when the configs match
+    CLIP4evl = clip_registry.lazy(args.clip4evl, device, args.clip_dtype)
   
     NetG,NetD,NetC,CLIP_IMG_ENCODER,CLIP_TXT_ENCODER = choose_model(args.model)
     # image encoder
@@ -40,16 +135,24 @@ def prepare_models(args):
     for p in CLIP_img_enc.parameters():
         p.requires_grad = False
     CLIP_img_enc.eval()
-    # text encoder
-    CLIP_txt_enc = CLIP_TXT_ENCODER(CLIP4trn).to(device)
-    for p in CLIP_txt_enc.parameters():
-        p.requires_grad = False
-    CLIP_txt_enc.eval()
+    # text encoder, not needed when the datasets read the text cache
+    if args.text_cache:
+        CLIP_txt_enc = None
+    else:
+        CLIP_txt_enc = CLIP_TXT_ENCODER(CLIP4trn).to(device)
+        for p in CLIP_txt_enc.parameters():
+            p.requires_grad = False
+        CLIP_txt_enc.eval()
     # GAN models
-    netG = NetG(args.nf, args.z_dim, args.cond_dim, args.imsize, args.ch_size, args.mixed_precision, CLIP4trn).to(device)
+    netG = NetG(args.nf, args.z_dim, args.cond_dim, args.imsize, args.ch_size, args.mixed_precision, CLIP4trn, args.swin).to(device)
     netD = NetD(args.nf, args.imsize, args.ch_size, args.mixed_precision).to(device)
     # netD=NetD().to(device)
     netC = NetC(args.nf, args.cond_dim, args.mixed_precision).to(device)
+    # activation checkpointing, recomputes the blocks in the backward pass instead of keeping their activations
+    netG.set_checkpointing(args.checkpoint_gblocks)
+    CLIP_img_enc.checkpoint_blocks = args.checkpoint_img_encoder
+    # VGG16 perceptual loss, the weights are only loaded once train() first calls it
+    percep_loss = PerceptualLoss(channels_last=args.percep_channels_last, detach_target=args.percep_detach_real).to(device)
     if (args.multi_gpus) and (args.train):
         print("Let's use", torch.cuda.device_count(), "GPUs!")
         netG = torch.nn.parallel.DistributedDataParallel(netG, broadcast_buffers=False,
@@ -61,7 +164,7 @@ def prepare_models(args):
         netC = torch.nn.parallel.DistributedDataParallel(netC, broadcast_buffers=False,
                                                           device_ids=[local_rank],
                                                           output_device=local_rank, find_unused_parameters=True)
-    return CLIP4trn, CLIP4evl, CLIP_img_enc, CLIP_txt_enc, netG, netD, netC
+    return CLIP4trn, CLIP4evl, CLIP_img_enc, CLIP_txt_enc, netG, netD, netC, percep_loss
 
 
 def prepare_dataset(args, split, transform):
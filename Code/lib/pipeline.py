@@ -0,0 +1,224 @@
+import importlib
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+import clip
+from lib.utils import load_yaml, load_netG
+from lib.image_writer import to_uint8
+
+
+def tile_starts(length, tile, stride):
+    starts = list(range(0, max(length - tile, 0) + 1, stride))
+    if starts[-1] + tile < length:
+        starts.append(length - tile)
+    return starts
+
+
+def feather_window(tile, overlap, device):
+    # linear ramps over the overlap on every side, the tile centre has weight 1
+    ramp = torch.ones(tile, device=device)
+    if overlap > 0:
+        edge = torch.arange(1, overlap + 1, device=device, dtype=torch.float32) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = torch.minimum(ramp[-overlap:], edge.flip(0))
+    return torch.outer(ramp, ramp)
+
+
+@torch.no_grad()
+def tiled_forward(netG, LR, c, tile=64, overlap=16, tile_batch=16, scale=4, out_device=None):
+    """Super-resolve one LR image of any size with NetG on overlapping tiles.
+
+    NetG works on a 64x64 LR grid, so the image is split into tile x tile
+    crops with the given overlap, tile_batch crops share one forward pass
+    with the same text embedding c, and the SR tiles are blended with
+    feathered weights. Peak memory is one tile batch plus the output
+    canvas, which lives on out_device (the LR device by default).
+
+    Args:
+        LR (Tensor): (1, 3, h, w) image in [-1, 1].
+        c (Tensor | Conditioning): (1, cond_dim) sentence embedding or its NetG.condition bundle.
+
+    Returns:
+        (Tensor): (1, 3, h*scale, w*scale) SR image in [-1, 1].
+    """
+    if LR.size(0) != 1:
+        raise ValueError('tiled_forward expects a single image, got a batch of %d.' % (LR.size(0)))
+    if not 0 <= overlap < tile:
+        raise ValueError('overlap must be in [0, tile).')
+    out_device = LR.device if out_device is None else out_device
+    h, w = LR.shape[2:]
+    # images smaller than a tile are padded up to one tile
+    pad_h, pad_w = max(tile - h, 0), max(tile - w, 0)
+    if pad_h or pad_w:
+        LR = F.pad(LR, (0, pad_w, 0, pad_h), mode='replicate')
+    H, W = LR.shape[2:]
+    stride = tile - overlap
+    boxes = [(y, x) for y in tile_starts(H, tile, stride) for x in tile_starts(W, tile, stride)]
+    window = feather_window(tile * scale, overlap * scale, out_device)
+    canvas = torch.zeros(1, 3, H * scale, W * scale, device=out_device)
+    weight = torch.zeros(1, 1, H * scale, W * scale, device=out_device)
+    for begin in range(0, len(boxes), tile_batch):
+        chunk = boxes[begin:begin + tile_batch]
+        tiles = torch.cat([LR[:, :, y:y + tile, x:x + tile] for y, x in chunk])
+        cond = c.expand(len(chunk), -1) if torch.is_tensor(c) else c
+        SR = netG(tiles, cond, eval=True).float().to(out_device)
+        for (y, x), sr in zip(chunk, SR):
+            y, x = y * scale, x * scale
+            canvas[0, :, y:y + tile * scale, x:x + tile * scale] += sr * window
+            weight[0, :, y:y + tile * scale, x:x + tile * scale] += window
+    return (canvas / weight)[:, :, :h * scale, :w * scale]
+
+
+class ConditioningCache:
+    """LRU cache of NetG conditioning bundles keyed by caption.
+
+    A miss tokenizes the caption, runs the text encoder and NetG.condition
+    once; hits skip all of that as well as the per-block gamma/beta MLPs.
+    Generators without a condition method (exported ones) get the cached
+    sentence embeddings instead.
+    """
+    def __init__(self, netG, text_encoder, device, max_size=256):
+        self.netG = netG
+        self.text_encoder = text_encoder
+        self.device = device
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+
+    @torch.no_grad()
+    def __call__(self, captions):
+        bundles = [self.entries.get(caption) for caption in captions]
+        miss = sorted(set(caption for caption, bundle in zip(captions, bundles) if bundle is None))
+        self.hits += len(captions) - len(miss)
+        self.misses += len(miss)
+        if len(miss) != 0:
+            tokens = clip.tokenize(miss, truncate=True).to(self.device)
+            sent_emb, words_embs = self.text_encoder(tokens)
+            if hasattr(self.netG, 'condition'):
+                cond = self.netG.condition(sent_emb)
+                rows = [type(cond)(cond.c[idx:idx + 1], cond.code[idx:idx + 1], cond.prompts[idx:idx + 1],
+                                   {m: (g[idx:idx + 1], b[idx:idx + 1]) for m, (g, b) in cond.affine.items()})
+                        for idx in range(len(miss))]
+            else:
+                rows = sent_emb.float().split(1)
+            for caption, row in zip(miss, rows):
+                self.entries[caption] = row
+        for caption in captions:
+            self.entries.move_to_end(caption)
+        bundles = [self.entries[caption] for caption in captions]
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        if len(set(captions)) == 1:
+            return bundles[0]
+        if torch.is_tensor(bundles[0]):
+            return torch.cat(bundles)
+        return type(bundles[0]).cat(bundles)
+
+
+class CLIPSRPipeline:
+    """Text-guided x4 super-resolution with a trained NetG.
+
+    Only the generator and the CLIP text encoder are built, so loading a
+    checkpoint needs neither the datasets nor NetD/NetC and their optimizers.
+
+        pipe = CLIPSRPipeline.from_pretrained('state_epoch_220.pth', 'cfg/CelebA.yml', device='cuda')
+        sr = pipe(lr_images, captions)
+    """
+    def __init__(self, netG, text_encoder, device='cpu', scale=4, cond_cache_size=256):
+        self.netG = netG.to(device).eval()
+        self.text_encoder = text_encoder.to(device).eval()
+        self.device = torch.device(device)
+        self.scale = scale
+        for p in list(self.netG.parameters()) + list(self.text_encoder.parameters()):
+            p.requires_grad = False
+        self.cond_cache = ConditioningCache(self.netG, self.text_encoder, self.device, cond_cache_size)
+
+    @classmethod
+    def from_pretrained(cls, checkpoint, cfg_file, device='cpu', model='net', clip_model=None):
+        """Build NetG from cfg_file and restore it from a state_epoch_*.pth checkpoint.
+
+        clip_model is the CLIP model NetG and the text encoder are built on;
+        by default cfg.clip4trn is loaded with clip.load.
+        """
+        cfg = load_yaml(cfg_file)
+        if clip_model is None:
+            clip_model = clip.load(cfg.clip4trn['type'], device=device)[0]
+        clip_model = clip_model.eval()
+        net = importlib.import_module('.%s' % (model), 'models')
+        netG = net.NetG(cfg.nf, cfg.z_dim, cfg.cond_dim, cfg.imsize, cfg.ch_size, False, clip_model, cfg.get('swin', False))
+        netG = load_netG(netG, checkpoint, False, train=False)
+        text_encoder = net.CLIP_TXT_ENCODER(clip_model)
+        return cls(netG, text_encoder, device)
+
+    @classmethod
+    def from_exported(cls, path, cfg_file, device='cpu', model='net', clip_model=None):
+        """Load a generator saved by lib.export.export_netG, the text encoder comes from CLIP."""
+        from lib.export import load_exported
+        cfg = load_yaml(cfg_file)
+        if clip_model is None:
+            clip_model = clip.load(cfg.clip4trn['type'], device=device)[0]
+        net = importlib.import_module('.%s' % (model), 'models')
+        text_encoder = net.CLIP_TXT_ENCODER(clip_model.eval())
+        return cls(load_exported(path, device), text_encoder, device)
+
+    def preprocess(self, images):
+        """Stack PIL images, uint8 HWC arrays or a (B, 3, h, w) tensor in [-1, 1] into a batch."""
+        if torch.is_tensor(images):
+            imgs = images.float()
+        else:
+            imgs = []
+            for img in images:
+                if isinstance(img, Image.Image):
+                    img = np.asarray(img.convert('RGB'))
+                imgs.append(torch.from_numpy(np.ascontiguousarray(img)).permute(2, 0, 1))
+            imgs = torch.stack(imgs).float().div_(127.5).sub_(1.)
+        if imgs.dim() == 3:
+            imgs = imgs.unsqueeze(0)
+        return imgs.to(self.device)
+
+    @torch.no_grad()
+    def encode_text(self, captions):
+        tokens = clip.tokenize(captions, truncate=True).to(self.device)
+        sent_emb, words_embs = self.text_encoder(tokens)
+        return sent_emb
+
+    @torch.no_grad()
+    def __call__(self, images, captions, output_type='tensor'):
+        """Super-resolve a batch of LR images, one caption per image.
+
+        output_type 'tensor' returns (B, 3, H, W) in [-1, 1], 'uint8' the
+        same as uint8 and 'pil' a list of PIL images.
+        """
+        if isinstance(captions, str):
+            captions = [captions]
+        LR = self.preprocess(images)
+        if LR.size(0) != len(captions):
+            raise ValueError('Got %d images but %d captions.' % (LR.size(0), len(captions)))
+        SR = self.netG(LR, self.cond_cache(captions), eval=True).float()
+        if output_type == 'tensor':
+            return SR
+        SR = to_uint8(SR)
+        if output_type == 'uint8':
+            return SR
+        if output_type == 'pil':
+            return [Image.fromarray(img) for img in SR.permute(0, 2, 3, 1).cpu().numpy()]
+        raise ValueError('Unknown output_type: %s' % (output_type))
+
+    @torch.no_grad()
+    def tiled(self, image, caption, tile=64, overlap=16, tile_batch=16, out_device=None):
+        """Super-resolve one image at its native resolution, see tiled_forward.
+
+        Returns a (1, 3, H, W) tensor in [-1, 1].
+        """
+        LR = self.preprocess([image] if not torch.is_tensor(image) else image)
+        return tiled_forward(self.netG, LR, self.cond_cache([caption]), tile, overlap, tile_batch, self.scale, out_device)
@@ -0,0 +1,189 @@
+import json
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+
+from lib.utils import dummy_context_mgr
+
+
+class PhaseTimer:
+    """Times one phase of a step.
+
+    On CUDA the phase is bracketed with events, so no sync happens until the
+    step is resolved; otherwise the host clock is used. Timers of the same
+    name add up within a step.
+    """
+    def __init__(self, profiler, name, host):
+        self.profiler = profiler
+        self.name = name
+        self.host = host or not profiler.cuda
+        self.record = None
+
+    def __enter__(self):
+        if self.profiler.tracing:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        if self.host:
+            self.start = time.perf_counter()
+        else:
+            self.start = torch.cuda.Event(enable_timing=True)
+            self.start.record()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.host:
+            self.profiler.pending.append((self.name, (time.perf_counter() - self.start) * 1000.))
+        else:
+            end = torch.cuda.Event(enable_timing=True)
+            end.record()
+            self.profiler.pending.append((self.name, (self.start, end)))
+        if self.record is not None:
+            self.record.__exit__(exc_type, exc_value, traceback)
+            self.record = None
+        return False
+
+
+class StepProfiler:
+    """Per-phase wall time of the training steps.
+
+    Wrap the parts of a step in phase(name), the dataloader in iterate() and
+    call step() at the end of each step. Every interval steps the CUDA events
+    are resolved with a single sync, and the rolling p50/p90/p99 over the last
+    window steps go to tensorboard under Profile/. summary() returns the same
+    statistics, save() writes them as JSON.
+
+    trace is an optional (first, last) global step range recorded with
+    torch.profiler into trace_dir, with the phases as named ranges.
+    A disabled profiler only hands out no-op contexts.
+    """
+    def __init__(self, enabled=True, device='cpu', writer=None, interval=50, window=200, trace=None, trace_dir=None):
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == 'cuda'
+        self.writer = writer
+        self.interval = max(int(interval), 1)
+        self.window = window
+        self.trace = trace if enabled else None
+        self.trace_dir = trace_dir
+        self.times = OrderedDict()
+        self.pending = []
+        self.steps = []
+        self.step_start = None
+        self.torch_profiler = None
+        self.dummy = dummy_context_mgr()
+
+    @property
+    def tracing(self):
+        return self.torch_profiler is not None
+
+    def phase(self, name, host=False):
+        """Context that times name; host=True uses the host clock even on CUDA."""
+        if not self.enabled:
+            return self.dummy
+        return PhaseTimer(self, name, host)
+
+    def iterate(self, iterable, name='data'):
+        """Yield from iterable, timing each fetch as phase name on the host clock."""
+        iterator = iter(iterable)
+        end = object()
+        if self.enabled:
+            self.step_start = time.perf_counter()
+        while True:
+            with self.phase(name, host=True):
+                item = next(iterator, end)
+            if item is end:
+                # the fetch that hit the end belongs to no step, drop its record
+                if self.enabled:
+                    self.pending.pop()
+                return
+            yield item
+
+    def begin(self, global_step):
+        """Start the torch.profiler window when global_step reaches it."""
+        if not self.enabled:
+            return
+        if self.step_start is None:
+            self.step_start = time.perf_counter()
+        if self.trace is not None and global_step == self.trace[0] and self.torch_profiler is None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.torch_profiler = torch.profiler.profile(activities=activities, record_shapes=True,
+                                                         on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir))
+            self.torch_profiler.__enter__()
+
+    def step(self, global_step):
+        """Close the current step."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.pending.append(('step', (now - self.step_start) * 1000.))
+        self.steps.append(self.pending)
+        self.pending = []
+        self.step_start = now
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+            if global_step >= self.trace[1]:
+                self.torch_profiler.__exit__(None, None, None)
+                self.torch_profiler = None
+                self.trace = None
+        if len(self.steps) >= self.interval:
+            self.flush(global_step)
+
+    def flush(self, global_step=None):
+        """Resolve the recorded steps and log the rolling statistics."""
+        if not self.steps:
+            return
+        if self.cuda:
+            torch.cuda.synchronize()
+        for records in self.steps:
+            step_times = OrderedDict()
+            for name, value in records:
+                if isinstance(value, tuple):
+                    value = value[0].elapsed_time(value[1])
+                step_times[name] = step_times.get(name, 0.) + value
+            for name, value in step_times.items():
+                if name not in self.times:
+                    self.times[name] = deque(maxlen=self.window)
+                self.times[name].append(value)
+        self.steps = []
+        if self.writer is not None and global_step is not None:
+            for name, stats in self.summary().items():
+                for key in ['p50', 'p90', 'p99']:
+                    self.writer.add_scalar('Profile/%s_%s' % (name, key), stats[key], global_step)
+
+    def summary(self):
+        """{phase: {'p50', 'p90', 'p99', 'mean', 'share'}} in ms over the rolling window."""
+        out = OrderedDict()
+        total = np.mean(self.times['step']) if 'step' in self.times else 0.
+        for name, values in self.times.items():
+            values = np.asarray(values)
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            out[name] = {'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'mean': float(values.mean()),
+                         'share': float(values.mean() / total) if total > 0 else 0.}
+        return out
+
+    def save(self, path):
+        self.flush()
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def report(self):
+        lines = ['%-14s %9s %9s %9s %7s' % ('phase', 'p50 ms', 'p90 ms', 'p99 ms', 'share')]
+        for name, stats in self.summary().items():
+            lines.append('%-14s %9.2f %9.2f %9.2f %6.1f%%' % (name, stats['p50'], stats['p90'], stats['p99'], stats['share'] * 100.))
+        return '\n'.join(lines)
+
+    def close(self):
+        if self.torch_profiler is not None:
+            self.torch_profiler.__exit__(None, None, None)
+            self.torch_profiler = None
+
+
+def parse_trace_steps(value):
+    """'first,last' global steps of the torch.profiler window, empty disables."""
+    if not value:
+        return None
+    first, last = [int(v) for v in str(value).split(',')]
+    return first, last
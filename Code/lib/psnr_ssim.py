@@ -0,0 +1,150 @@
+import torch
+import torch.nn.functional as F
+from torch import distributed as dist
+
+from lib.color_util import rgb2ycbcr_pt
+
+
+def to_unit_range(img, min_max=(-1, 1), quantize=True):
+    """Map network outputs to [0, 1], optionally rounded to 8-bit levels.
+
+    Args:
+        img (Tensor): Images with shape (n, c, h, w) in the range min_max.
+        min_max (tuple): Value range of the input. Default: (-1, 1).
+        quantize (bool): Round to 1/255 steps like saving a uint8 image. Default: True.
+
+    Returns:
+        (Tensor): Images with the range [0, 1], float64.
+    """
+    img = img.detach().to(torch.float64).clamp(*min_max)
+    img = (img - min_max[0]) / (min_max[1] - min_max[0])
+    if quantize:
+        img = (img * 255.).round() / 255.
+    return img
+
+
+def _prepare(img, img2, crop_border, test_y_channel):
+    if img.shape != img2.shape:
+        raise ValueError(f'Image shapes are different: {img.shape}, {img2.shape}.')
+    if crop_border != 0:
+        img = img[:, :, crop_border:-crop_border, crop_border:-crop_border]
+        img2 = img2[:, :, crop_border:-crop_border, crop_border:-crop_border]
+    if test_y_channel:
+        img = rgb2ycbcr_pt(img, y_only=True)
+        img2 = rgb2ycbcr_pt(img2, y_only=True)
+    return img.to(torch.float64), img2.to(torch.float64)
+
+
+def calculate_psnr_pt(img, img2, crop_border=0, test_y_channel=False):
+    """Calculate PSNR (Peak Signal-to-Noise Ratio) per image (PyTorch version).
+
+    Args:
+        img (Tensor): Images with range [0, 1], shape (n, 3/1, h, w).
+        img2 (Tensor): Images with range [0, 1], shape (n, 3/1, h, w).
+        crop_border (int): Cropped pixels in each edge of an image. These pixels are not involved in the calculation.
+        test_y_channel (bool): Test on Y channel of YCbCr. Default: False.
+
+    Returns:
+        (Tensor): PSNR results with shape (n,), inf for identical images like
+            lib.utils_image.calculate_psnr and skimage.
+    """
+    img, img2 = _prepare(img, img2, crop_border, test_y_channel)
+    mse = torch.mean((img - img2)**2, dim=[1, 2, 3])
+    return torch.where(mse == 0, torch.full_like(mse, float('inf')), 10. * torch.log10(1. / mse))
+
+
+def _gaussian_window(channels, device, size=11, sigma=1.5):
+    coords = torch.arange(size, dtype=torch.float64, device=device) - (size - 1) / 2.
+    kernel = torch.exp(-coords**2 / (2 * sigma**2))
+    kernel = kernel / kernel.sum()
+    window = torch.outer(kernel, kernel)
+    return window.view(1, 1, size, size).expand(channels, 1, size, size)
+
+
+def _ssim_pth(img, img2):
+    """Calculate SSIM per image with the MATLAB settings (11x11 Gaussian, sigma 1.5, valid mode).
+
+    Args:
+        img (Tensor): Images with range [0, 255], shape (n, c, h, w).
+        img2 (Tensor): Images with range [0, 255], shape (n, c, h, w).
+
+    Returns:
+        (Tensor): SSIM results with shape (n,), averaged over channels.
+    """
+    c1 = (0.01 * 255)**2
+    c2 = (0.03 * 255)**2
+    window = _gaussian_window(img.size(1), img.device)
+
+    mu1 = F.conv2d(img, window, stride=1, padding=0, groups=img.shape[1])
+    mu2 = F.conv2d(img2, window, stride=1, padding=0, groups=img2.shape[1])
+    mu1_sq = mu1.pow(2)
+    mu2_sq = mu2.pow(2)
+    mu1_mu2 = mu1 * mu2
+    sigma1_sq = F.conv2d(img * img, window, stride=1, padding=0, groups=img.shape[1]) - mu1_sq
+    sigma2_sq = F.conv2d(img2 * img2, window, stride=1, padding=0, groups=img.shape[1]) - mu2_sq
+    sigma12 = F.conv2d(img * img2, window, stride=1, padding=0, groups=img.shape[1]) - mu1_mu2
+
+    cs_map = (2 * sigma12 + c2) / (sigma1_sq + sigma2_sq + c2)
+    ssim_map = ((2 * mu1_mu2 + c1) / (mu1_sq + mu2_sq + c1)) * cs_map
+    return ssim_map.mean([1, 2, 3])
+
+
+def calculate_ssim_pt(img, img2, crop_border=0, test_y_channel=False):
+    """Calculate SSIM (structural similarity) per image (PyTorch version).
+
+    Same outputs as MATLAB's ssim and lib.utils_image.calculate_ssim.
+
+    Args:
+        img (Tensor): Images with range [0, 1], shape (n, 3/1, h, w).
+        img2 (Tensor): Images with range [0, 1], shape (n, 3/1, h, w).
+        crop_border (int): Cropped pixels in each edge of an image. These pixels are not involved in the calculation.
+        test_y_channel (bool): Test on Y channel of YCbCr. Default: False.
+
+    Returns:
+        (Tensor): SSIM results with shape (n,).
+    """
+    img, img2 = _prepare(img, img2, crop_border, test_y_channel)
+    return _ssim_pth(img * 255., img2 * 255.)
+
+
+class PSNR_SSIM_Meter:
+    """Accumulates per-image PSNR/SSIM on the device of the images.
+
+    Nothing is copied to the host until result() is called, which also sums
+    the totals over all ranks when torch.distributed is initialized.
+    ssim=False skips the SSIM convolutions; update() and result() then
+    return None for it.
+    """
+    def __init__(self, crop_border=0, test_y_channel=False, min_max=(-1, 1), ssim=True):
+        self.crop_border = crop_border
+        self.test_y_channel = test_y_channel
+        self.min_max = min_max
+        self.ssim = ssim
+        self.reset()
+
+    def reset(self):
+        self.psnr_sum, self.ssim_sum, self.count = 0., 0., 0
+
+    @torch.no_grad()
+    def update(self, sr, hr):
+        sr = to_unit_range(sr, self.min_max)
+        hr = to_unit_range(hr, self.min_max)
+        psnr = calculate_psnr_pt(sr, hr, self.crop_border, self.test_y_channel)
+        self.psnr_sum = self.psnr_sum + psnr.sum()
+        self.count += psnr.numel()
+        if not self.ssim:
+            return psnr, None
+        ssim = calculate_ssim_pt(sr, hr, self.crop_border, self.test_y_channel)
+        self.ssim_sum = self.ssim_sum + ssim.sum()
+        return psnr, ssim
+
+    def result(self):
+        if self.count == 0:
+            return float('nan'), float('nan') if self.ssim else None
+        count = torch.tensor(float(self.count), dtype=torch.float64, device=self.psnr_sum.device)
+        ssim_sum = self.ssim_sum if self.ssim else torch.zeros_like(count)
+        totals = torch.stack([self.psnr_sum, ssim_sum, count])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)
+        psnr_sum, ssim_sum, count = totals.tolist()
+        return psnr_sum / count, ssim_sum / count if self.ssim else None
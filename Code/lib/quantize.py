@@ -0,0 +1,116 @@
+import copy
+
+import torch
+import torch.nn as nn
+# the pre-torch.ao namespaces, available from the pinned torch 1.11 on
+import torch.nn.quantized as nnq
+from torch.quantization import HistogramObserver, PerChannelMinMaxObserver
+
+
+class Int8Layer(nn.Module):
+    """Post-training static int8 version of a Conv2d or Linear.
+
+    After prepare_int8 the layer runs in float and observes its input and
+    output ranges; convert() then swaps in the quantized kernel with
+    per-channel int8 weights. The input is quantized and the output
+    dequantized around it, so the surrounding float code is unchanged.
+    """
+    def __init__(self, module):
+        super(Int8Layer, self).__init__()
+        self.float_module = module
+        self.in_observer = HistogramObserver(dtype=torch.quint8, reduce_range=True)
+        self.out_observer = HistogramObserver(dtype=torch.quint8, reduce_range=True)
+        self.qmodule = None
+
+    @property
+    def weight(self):
+        return self.float_module.weight
+
+    def forward(self, x):
+        if self.qmodule is None:
+            self.in_observer(x.detach())
+            out = self.float_module(x)
+            self.out_observer(out.detach())
+            return out
+        scale, zero_point = self.in_scale
+        xq = torch.quantize_per_tensor(x.float().contiguous(), scale, zero_point, torch.quint8)
+        return self.qmodule(xq).dequantize()
+
+    @torch.no_grad()
+    def convert(self):
+        module = self.float_module
+        w_observer = PerChannelMinMaxObserver(ch_axis=0, dtype=torch.qint8, qscheme=torch.per_channel_symmetric)
+        w_observer(module.weight.float())
+        w_scale, w_zero_point = w_observer.calculate_qparams()
+        qweight = torch.quantize_per_channel(module.weight.float(), w_scale.double(), w_zero_point, 0, torch.qint8)
+        bias = module.bias.float() if module.bias is not None else None
+        if isinstance(module, nn.Conv2d):
+            qmodule = nnq.Conv2d(module.in_channels, module.out_channels, module.kernel_size, module.stride,
+                                 module.padding, module.dilation, module.groups, module.bias is not None)
+        else:
+            qmodule = nnq.Linear(module.in_features, module.out_features, module.bias is not None)
+        qmodule.set_weight_bias(qweight, bias)
+        out_scale, out_zero_point = self.out_observer.calculate_qparams()
+        qmodule.scale, qmodule.zero_point = float(out_scale), int(out_zero_point)
+        in_scale, in_zero_point = self.in_observer.calculate_qparams()
+        self.in_scale = (float(in_scale), int(in_zero_point))
+        self.qmodule = qmodule
+
+
+def quantizable(module):
+    if isinstance(module, nn.Conv2d):
+        return module.padding_mode == 'zeros' and not isinstance(module.padding, str)
+    return type(module) is nn.Linear
+
+
+def prepare_int8(model, skip=()):
+    """Wrap every Conv2d and Linear of model in an observing Int8Layer, in place.
+
+    skip holds name prefixes of submodules to keep in float. Returns the
+    names of the wrapped layers.
+    """
+    wrapped = []
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            full_name = '%s.%s' % (name, child_name) if name else child_name
+            if any(full_name == s or full_name.startswith(s + '.') for s in skip):
+                continue
+            if quantizable(child):
+                setattr(module, child_name, Int8Layer(child))
+                wrapped.append(full_name)
+    return wrapped
+
+
+def convert_int8(model):
+    """Switch every calibrated Int8Layer of model to its int8 kernel."""
+    if 'x86' in torch.backends.quantized.supported_engines:
+        torch.backends.quantized.engine = 'x86'
+    for module in model.modules():
+        if isinstance(module, Int8Layer):
+            module.convert()
+    return model
+
+
+# the text conditioning is computed once per prompt (NetG.condition), and the
+# layers right at the image input and output are the most sensitive to rounding
+NETG_FLOAT_LAYERS = ('fc_code', 'mapping.fc_prompt', 'head', 'c1', 'tail', 'to_rgb')
+
+
+def quantize_netG(netG, calib_batches, skip=NETG_FLOAT_LAYERS):
+    """Calibrate NetG on (LR, sent_emb) batches and return an int8 copy of it.
+
+    netG is left untouched: its CLIP_Mapper blocks are the modules of the
+    CLIP model, and prepare_int8 swaps layers in place, so the layers are
+    swapped in a deep copy.
+
+    Covers the generator convs, the M_Block/G_Block convs and the Linear
+    layers of the frozen CLIP blocks in CLIP_Mapper. The Affine MLPs stay in
+    float because they only run when a prompt is conditioned.
+    """
+    netG = copy.deepcopy(netG).eval()
+    skip = tuple(skip) + tuple(name for name, m in netG.named_modules() if type(m).__name__ == 'Affine')
+    prepare_int8(netG, skip)
+    with torch.no_grad():
+        for LR, sent_emb in calib_batches:
+            netG(LR, sent_emb, eval=True)
+    return convert_int8(netG)
@@ -0,0 +1,179 @@
+import io
+import json
+import time
+import base64
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+
+class MicroBatcher:
+    """Groups single (LR image, caption) requests into batched NetG calls.
+
+    A worker thread waits for the first pending request, then collects more
+    for up to max_wait seconds or until max_batch_size requests are queued,
+    runs them through the pipeline in one forward pass and resolves every
+    request's Future with its SR image (uint8, HWC). Images of different
+    sizes are never stacked together; they go into separate batches.
+    """
+    def __init__(self, pipeline, max_batch_size=8, max_wait=0.01, window=1000):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.running = True
+        self.start_time = time.time()
+        self.num_requests, self.num_batches = 0, 0
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image, caption):
+        future = Future()
+        with self.cond:
+            if not self.running:
+                raise RuntimeError('MicroBatcher is closed.')
+            self.queue.append((np.ascontiguousarray(image), caption, future, time.time()))
+            self.cond.notify()
+        return future
+
+    def __call__(self, image, caption, timeout=None):
+        return self.submit(image, caption).result(timeout)
+
+    def next_batch(self):
+        with self.cond:
+            while self.running and len(self.queue) == 0:
+                self.cond.wait()
+            if len(self.queue) == 0:
+                return []
+            deadline = self.queue[0][3] + self.max_wait
+            while self.running and len(self.queue) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            # take the oldest request and every queued request with the same LR size
+            shape = self.queue[0][0].shape
+            batch, rest = [], deque()
+            while len(self.queue) != 0:
+                item = self.queue.popleft()
+                if item[0].shape == shape and len(batch) < self.max_batch_size:
+                    batch.append(item)
+                else:
+                    rest.append(item)
+            self.queue = rest
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if len(batch) == 0:
+                if not self.running:
+                    return
+                continue
+            images = [item[0] for item in batch]
+            captions = [item[1] for item in batch]
+            try:
+                SR = self.pipeline(images, captions, output_type='uint8')
+                SR = SR.permute(0, 2, 3, 1).cpu().numpy()
+            except Exception as e:
+                for item in batch:
+                    item[2].set_exception(e)
+                continue
+            now = time.time()
+            with self.cond:
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.batch_sizes.append(len(batch))
+                self.latencies.extend(now - item[3] for item in batch)
+            for item, img in zip(batch, SR):
+                item[2].set_result(img)
+
+    def metrics(self):
+        with self.cond:
+            latencies = np.array(self.latencies) * 1000.
+            batch_sizes = np.array(self.batch_sizes)
+            uptime = time.time() - self.start_time
+            metrics = {
+                'requests': self.num_requests,
+                'batches': self.num_batches,
+                'queued': len(self.queue),
+                'uptime_s': uptime,
+                'throughput_rps': self.num_requests / max(uptime, 1e-9),
+                'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else 0.,
+            }
+        for q in (50, 95, 99):
+            metrics['latency_p%d_ms' % (q)] = float(np.percentile(latencies, q)) if len(latencies) else 0.
+        return metrics
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+
+
+def decode_image(data):
+    return np.asarray(Image.open(io.BytesIO(base64.b64decode(data))).convert('RGB'))
+
+
+def encode_image(img):
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format='PNG')
+    return base64.b64encode(buf.getvalue()).decode('ascii')
+
+
+class SRRequestHandler(BaseHTTPRequestHandler):
+    """POST /sr with {"image": base64 PNG/JPEG, "caption": str} returns {"image": base64 PNG}.
+
+    GET /metrics returns the MicroBatcher metrics.
+    """
+    batcher = None
+    timeout_s = 60.
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.batcher.metrics())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/sr':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            image = decode_image(request['image'])
+            caption = str(request['caption'])
+        except Exception as e:
+            self.send_json(400, {'error': 'bad request: %s' % (e)})
+            return
+        try:
+            SR = self.batcher(image, caption, self.timeout_s)
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+        self.send_json(200, {'image': encode_image(SR)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(batcher, host='127.0.0.1', port=8000):
+    handler = type('Handler', (SRRequestHandler,), {'batcher': batcher})
+    return ThreadingHTTPServer((host, port), handler)
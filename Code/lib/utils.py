@@ -246,9 +246,44 @@ class VGG16FeatureExtractor(nn.Module):
     def forward(self, x):
         return self.feature_extractor(x)
 
-def perceptual_loss(input, target, feature_layer=34):
-    vgg16_extractor = VGG16FeatureExtractor(feature_layer).cuda()
-    input_features = vgg16_extractor(input)
-    target_features = vgg16_extractor(target)
-    loss = F.mse_loss(input_features, target_features)
-    return loss
\ No newline at end of file
+class PerceptualLoss(nn.Module):
+    """Frozen VGG16 feature loss; the VGG weights are loaded on the first call.
+
+    Inputs are images in [-1, 1] and are normalized to ImageNet statistics.
+    The module always stays in eval mode and runs under the caller's autocast.
+    """
+    def __init__(self, feature_layer=34, channels_last=False, detach_target=True):
+        super(PerceptualLoss, self).__init__()
+        self.feature_layer = feature_layer
+        self.channels_last = channels_last
+        self.detach_target = detach_target
+        self.register_buffer('mean', torch.tensor([0.485, 0.456, 0.406]).view(1, 3, 1, 1))
+        self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]).view(1, 3, 1, 1))
+        self.extractor = None
+
+    def train(self, mode=True):
+        return super(PerceptualLoss, self).train(False)
+
+    def build(self, device):
+        self.extractor = VGG16FeatureExtractor(self.feature_layer).to(device).eval()
+        for p in self.extractor.parameters():
+            p.requires_grad = False
+        if self.channels_last:
+            self.extractor = self.extractor.to(memory_format=torch.channels_last)
+
+    def features(self, x):
+        x = ((x * 0.5 + 0.5) - self.mean) / self.std
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return self.extractor(x)
+
+    def forward(self, input, target):
+        if self.extractor is None:
+            self.build(input.device)
+        input_features = self.features(input)
+        if self.detach_target:
+            with torch.no_grad():
+                target_features = self.features(target)
+        else:
+            target_features = self.features(target)
+        return F.mse_loss(input_features.float(), target_features.float())
@@ -1,5 +1,6 @@
 import os
 import math
+import functools
 import random
 import numpy as np
 import torch
@@ -752,6 +753,43 @@ def imresize(img, scale, antialiasing=True):
     return out_2
 
 
+# --------------------------------------------
+# batched imresize for tensor images [0, 1]
+# --------------------------------------------
+@functools.lru_cache(maxsize=32)
+def calculate_resize_matrix(in_length, out_length, scale, antialiasing=True):
+    # Fold the cubic weights, the window indices and the symmetric padding
+    # used by imresize into one dense (out_length, in_length) matrix, so a
+    # resize along one axis becomes a single matmul.
+    weights, indices, sym_len_s, _ = calculate_weights_indices(
+        in_length, out_length, scale, 'cubic', 4, antialiasing)
+    # padded position -> source position (mirror at both borders)
+    pos = indices.long() - sym_len_s
+    pos = torch.where(pos < 0, -pos - 1, pos)
+    pos = torch.where(pos >= in_length, 2 * in_length - 1 - pos, pos)
+    matrix = torch.zeros(out_length, in_length)
+    matrix.scatter_add_(1, pos, weights)
+    return matrix
+
+
+@functools.lru_cache(maxsize=32)
+def resize_matrix(in_length, out_length, scale, antialiasing, device, dtype):
+    # calculate_resize_matrix already on device in dtype, so GPU batches do not pay a
+    # host-to-device copy per call; the cached tensor is shared, never modify it
+    return calculate_resize_matrix(in_length, out_length, scale, antialiasing).to(device, dtype)
+
+
+def imresize_batch(img, scale, antialiasing=True):
+    # Same output as imresize, but for HW, CHW or BCHW tensors on any device
+    # input: img: pytorch tensor [0,1]
+    # output: same layout as the input [0,1] w/o round
+    in_H, in_W = img.shape[-2:]
+    out_H, out_W = math.ceil(in_H * scale), math.ceil(in_W * scale)
+    weights_H = resize_matrix(in_H, out_H, scale, antialiasing, img.device, img.dtype)
+    weights_W = resize_matrix(in_W, out_W, scale, antialiasing, img.device, img.dtype)
+    return torch.matmul(torch.matmul(weights_H, img), weights_W.t())
+
+
 # --------------------------------------------
 # imresize for numpy image [0, 1]
 # --------------------------------------------
@@ -5,8 +5,38 @@ import torch.nn.functional as F
 from collections import OrderedDict
 from lib.utils import dummy_context_mgr
 import math
-from .swin import SwinIR,RSTB
+from .swin import RSTB,PatchEmbed,PatchUnEmbed
 from torch.nn.utils import spectral_norm
+from torch.utils.checkpoint import checkpoint
+
+def tokens_to_map(x, grid, dtype, out=None):
+    """(1+grid*grid, B, C) ViT tokens without the class token as a (B, C, grid, grid) map.
+
+    The layout change and the cast to dtype happen in a single copy, into out
+    when it is given.
+    """
+    tokens = x[1:].permute(1, 2, 0)
+    if out is None:
+        out = torch.empty(tokens.shape, dtype=dtype, device=x.device)
+    out.copy_(tokens)
+    return out.view(out.size(0), out.size(1), grid, grid)
+
+
+def segment_bounds(num, size, splits=()):
+    """(begin, end) ranges covering num blocks, size blocks each (0 for one range), also cut at splits."""
+    size = size or num
+    cuts = sorted(set(range(size, num, size)) | set(s for s in splits if 0 < s < num) | {num})
+    return list(zip([0] + cuts[:-1], cuts))
+
+
+def checkpointed(enabled, fn, *args):
+    """fn(*args); when enabled and gradients are recorded, its activations are
+    recomputed in the backward pass instead of being kept.
+    """
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
+
 
 class CLIP_IMG_ENCODER(nn.Module):
     def __init__(self, CLIP):
@@ -16,6 +46,13 @@ class CLIP_IMG_ENCODER(nn.Module):
         self.define_module(model)
         for param in self.parameters():
             param.requires_grad = False
+        # the CLIP input normalization ((x+1)*0.5-mean)/var as one multiply-add
+        mean = torch.tensor([0.48145466, 0.4578275, 0.40821073]).view(1, 3, 1, 1)
+        var = torch.tensor([0.26862954, 0.26130258, 0.27577711]).view(1, 3, 1, 1)
+        self.register_buffer('input_scale', 0.5 / var, persistent=False)
+        self.register_buffer('input_shift', (0.5 - mean) / var, persistent=False)
+        # resblocks per activation checkpoint segment, 0 keeps all activations
+        self.checkpoint_blocks = 0
 
     def define_module(self, model):
         self.conv1 = model.conv1
@@ -30,22 +67,15 @@ class CLIP_IMG_ENCODER(nn.Module):
     def dtype(self):
         return self.conv1.weight.dtype
 
-    def transf_to_CLIP_input(self,inputs):
-        device = inputs.device
-        if len(inputs.size()) != 4:
-            raise ValueError('Expect the (B, C, X, Y) tensor.')
-        else:
-            mean = torch.tensor([0.48145466, 0.4578275, 0.40821073])\
-                .unsqueeze(-1).unsqueeze(-1).unsqueeze(0).to(device)
-            var = torch.tensor([0.26862954, 0.26130258, 0.27577711])\
-                .unsqueeze(-1).unsqueeze(-1).unsqueeze(0).to(device)
-            inputs = F.interpolate(inputs*0.5+0.5, size=(224, 224))
-            inputs = ((inputs+1)*0.5-mean)/var
-            return inputs
+    def run_blocks(self, x, begin, end):
+        for i in range(begin, end):
+            x = self.transformer.resblocks[i](x)
+        return x
 
     def forward(self, img: torch.Tensor):
-        x = self.transf_to_CLIP_input(img)
-        x = x.type(self.dtype)
+        # cast once on the way in and once on the way out, the blocks run in the CLIP storage dtype
+        x = F.interpolate(img*0.5+0.5, size=(224, 224))
+        x = torch.addcmul(self.input_shift, x, self.input_scale).to(self.dtype)
         x = self.conv1(x)
         grid =  x.size(-1)
         x = x.reshape(x.shape[0], x.shape[1], -1)
@@ -55,16 +85,17 @@ class CLIP_IMG_ENCODER(nn.Module):
         x = self.ln_pre(x)
         x = x.permute(1, 0, 2)
         selected = [1,4,8]
-        local_features = []
-        for i in range(12):
-            x = self.transformer.resblocks[i](x)
-            if i in selected:
-                local_features.append(x.permute(1, 0, 2)[:, 1:, :].permute(0, 2, 1).reshape(-1, 768, grid, grid).contiguous().type(img.dtype))
+        local_features = torch.empty(x.size(1), len(selected), x.size(2), grid * grid, dtype=img.dtype, device=x.device)
+        # the segments end after the selected blocks, so their outputs are read outside the checkpoints
+        for begin, end in segment_bounds(12, self.checkpoint_blocks, [i + 1 for i in selected]):
+            x = checkpointed(self.checkpoint_blocks and x.requires_grad, self.run_blocks, x, begin, end)
+            if end - 1 in selected:
+                tokens_to_map(x, grid, img.dtype, local_features[:, selected.index(end - 1)])
         x = x.permute(1, 0, 2)
         x = self.ln_post(x[:, 0, :])
         if self.proj is not None:
             x = x @ self.proj
-        return torch.stack(local_features, dim=1), x.type(img.dtype)
+        return local_features.view(x.size(0), len(selected), -1, grid, grid), x.type(img.dtype)
 
 
 class CLIP_TXT_ENCODER(nn.Module):
@@ -105,6 +136,8 @@ class CLIP_Mapper(nn.Module):
         self.define_module(model)
         for param in model.parameters():
             param.requires_grad = False
+        # the resblocks that get a prompt token appended
+        self.prompt_blocks = [1,2,3,4,5,6,7,8]
 
     def define_module(self, model):
         self.conv1 = model.conv1
@@ -117,6 +150,17 @@ class CLIP_Mapper(nn.Module):
     def dtype(self):
         return self.conv1.weight.dtype
 
+    def run_blocks(self, x, prompts, begin, end):
+        for i in range(begin, end):
+            if i in self.prompt_blocks:
+                prompt = prompts[:,self.prompt_blocks.index(i),:].unsqueeze(0)
+                x = torch.cat((x,prompt), dim=0)
+                x = self.transformer.resblocks[i](x)
+                x = x[:-1,:,:]
+            else:
+                x = self.transformer.resblocks[i](x)
+        return x
+
     def forward(self, img: torch.Tensor, prompts: torch.Tensor):
 
         x = img.type(self.dtype)
@@ -130,19 +174,8 @@ class CLIP_Mapper(nn.Module):
         x = x + self.positional_embedding.to(x.dtype)
         x = self.ln_pre(x)
         x = x.permute(1, 0, 2)
-        selected = [1,2,3,4,5,6,7,8]
-        begin, end = 0, 12
-        prompt_idx = 0
-        for i in range(begin, end):
-            if i in selected:
-                prompt = prompts[:,prompt_idx,:].unsqueeze(0)
-                prompt_idx = prompt_idx+1
-                x = torch.cat((x,prompt), dim=0)
-                x = self.transformer.resblocks[i](x)
-                x = x[:-1,:,:]
-            else:
-                x = self.transformer.resblocks[i](x)
-        return x.permute(1, 0, 2)[:, 1:, :].permute(0, 2, 1).reshape(-1, 768, grid, grid).contiguous().type(img.dtype)
+        x = self.run_blocks(x, prompts, 0, 12)
+        return tokens_to_map(x, grid, img.dtype)
 
 
 class CLIP_Adapter(nn.Module):
@@ -159,15 +192,79 @@ class CLIP_Adapter(nn.Module):
         self.fc_prompt = nn.Linear(cond_dim, CLIP_ch*8)
 
     def forward(self,out,c,LR):
-        prompts = self.fc_prompt(c).view(c.size(0),-1,self.CLIP_ch)
+        if isinstance(c, Conditioning):
+            prompts = c.prompts
+        else:
+            prompts = self.fc_prompt(c).view(c.size(0),-1,self.CLIP_ch)
+        if prompts.size(0) != LR.size(0):
+            prompts = prompts.expand(LR.size(0), -1, -1)
         fuse_feat = self.conv_fuse(LR)
         map_feat = self.CLIP_ViT(fuse_feat,prompts)
         return self.conv(fuse_feat+0.1*map_feat)
 
 
 
+class Conditioning:
+    """Everything NetG derives from the sentence embedding c, computed once.
+
+    Holds c, the fc_code output, the CLIP_Adapter prompts and the gamma/beta
+    of the Affine layers that reach the output, keyed by the layer; the
+    others compute theirs from c. NetG.forward accepts it in place
+    of c; a bundle of batch size 1 is broadcast over the LR batch.
+    """
+    def __init__(self, c, code, prompts, affine):
+        self.c = c
+        self.code = code
+        self.prompts = prompts
+        self.affine = affine
+
+    def __len__(self):
+        return self.c.size(0)
+
+    def to(self, device):
+        return Conditioning(self.c.to(device), self.code.to(device), self.prompts.to(device),
+                            {m: (g.to(device), b.to(device)) for m, (g, b) in self.affine.items()})
+
+    @staticmethod
+    def cat(bundles):
+        affine = {m: (torch.cat([b.affine[m][0] for b in bundles]), torch.cat([b.affine[m][1] for b in bundles]))
+                  for m in bundles[0].affine}
+        return Conditioning(torch.cat([b.c for b in bundles]), torch.cat([b.code for b in bundles]),
+                            torch.cat([b.prompts for b in bundles]), affine)
+
+
+class Swin_Refine(nn.Module):
+    def __init__(self, dim, imsize, num_heads=4, window_size=4):
+        super(Swin_Refine, self).__init__()
+        # one RSTB built for a fixed imsize, so its attention masks are buffers
+        self.patch_embed = PatchEmbed(img_size=imsize, patch_size=1, in_chans=dim, embed_dim=dim, norm_layer=None)
+        self.layer = RSTB(dim=dim,
+                         input_resolution=(imsize, imsize),
+                         depth=1,
+                         num_heads=num_heads,
+                         window_size=window_size,
+                         mlp_ratio=4.,
+                         qkv_bias=True, qk_scale=None,
+                         drop=0., attn_drop=0.,
+                         norm_layer=nn.LayerNorm,
+                         downsample=None,
+                         use_checkpoint=False,
+                         img_size=imsize,
+                         patch_size=1,
+                         resi_connection='1conv')
+        self.norm = nn.LayerNorm(dim)
+        self.patch_unembed = PatchUnEmbed(img_size=imsize, patch_size=1, in_chans=dim, embed_dim=dim, norm_layer=None)
+
+    def forward(self, x):
+        x_size = (x.shape[2], x.shape[3])
+        x = self.patch_embed(x)
+        x = self.layer(x, x_size)
+        x = self.norm(x)
+        return self.patch_unembed(x, x_size)
+
+
 class NetG(nn.Module):
-    def __init__(self, ngf, nz, cond_dim, imsize, ch_size, mixed_precision, CLIP):
+    def __init__(self, ngf, nz, cond_dim, imsize, ch_size, mixed_precision, CLIP, swin=False):
         super(NetG, self).__init__()
         self.ngf = ngf
         self.mixed_precision = mixed_precision
@@ -176,6 +273,8 @@ class NetG(nn.Module):
         self.fc_code = nn.Linear(nz, self.code_sz*self.code_sz*self.code_ch)
         self.mapping = CLIP_Adapter(self.code_ch, self.mid_ch, self.code_ch, ngf*8, self.CLIP_ch, cond_dim, 3, 1, 1, 4, CLIP)
         self.GBlocks = nn.ModuleList([])
+        # forward only runs the first four, one per encoder feature
+        self.num_GBlocks = 4
         self.TBlocks=  M_Block(512, 32, 512, cond_dim, 3, 1, 1)
         in_out_pairs = list(get_G_in_out_chs(ngf, 256))
         self.embed_dim=256
@@ -222,41 +321,39 @@ class NetG(nn.Module):
                                                  nn.Conv2d(embed_dim // 4, embed_dim // 4, 1, 1, 0),
                                                  nn.LeakyReLU(negative_slope=0.2, inplace=True),
                                                  nn.Conv2d(embed_dim // 4, embed_dim, 3, 1, 1))
-    def forward_swin(self,x):
-        
-        x_size = (x.shape[2], x.shape[3])
-        chans=x.shape[1]
-        a=SwinIR(in_chans=x.shape[1],embed_dim=x.shape[1],img_size=(x.shape[2],x.shape[3]), patch_norm=None)
-        a.to(torch.device("cuda:0"))
-        x=a.patch_embed(x)
-        if a.ape:
-            x = x + a.absolute_pos_embed
-        x = a.pos_drop(x)
-        patches_resolution=a.patch_embed.patches_resolution
-               
-        layer=RSTB(dim=chans,
-                         input_resolution=(patches_resolution[0],
-                                           patches_resolution[1]),
-                         depth=1,
-                         num_heads=4,
-                         window_size=4,
-                         mlp_ratio=4.,
-                         qkv_bias=True, qk_scale=None,
-                         drop=0., attn_drop=0.,
-                          # no impact on SR results
-                         norm_layer=nn.LayerNorm,
-                         downsample=None,
-                         use_checkpoint=False,
-                         img_size=x_size,
-                         patch_size=1,
-                         resi_connection='1conv')
-        layer.to(torch.device("cuda:0"))
-        x=layer(x,x_size)
-        x = a.norm(x)
-        x = a.patch_unembed(x, x_size)
-        
-        return x
-        
+        # the G body works on the 64x64 grid the LR input is resized to
+        self.swin = Swin_Refine(embed_dim, 64) if swin else None
+        # G_Blocks per activation checkpoint segment, 0 keeps all activations
+        self.checkpoint_blocks = 0
+        # not a submodule, it only references the Affine layers registered above
+        # only the Affines of the G_Blocks that run: the CLIP_Adapter output (and with it the
+        # TBlocks output it reads) is overwritten in forward, so those Affines must keep grad None
+        self.fused_affine = FusedAffine(m for m in self.GBlocks[:self.num_GBlocks].modules() if isinstance(m, Affine))
+
+    def condition(self, c, fused=True):
+        """Precompute the conditioning of sentence embeddings c, see Conditioning."""
+        c = c.float()
+        if fused:
+            affine = self.fused_affine(c)
+        else:
+            affine = {m: (m.fc_gamma(c), m.fc_beta(c)) for m in self.fused_affine.affines}
+        prompts = self.mapping.fc_prompt(c).view(c.size(0), -1, self.CLIP_ch)
+        return Conditioning(c, self.fc_code(c), prompts, affine)
+
+    def set_checkpointing(self, gblocks=0):
+        """G_Blocks per activation checkpoint segment, 0 disables.
+
+        CLIP_Mapper is not checkpointed: forward overwrites the CLIP_Adapter
+        output, so its graph is freed right away and holds no memory.
+        """
+        self.checkpoint_blocks = gblocks
+
+    def run_GBlocks(self, out, c, skips, begin, end):
+        # each G_Block output is added to the encoder feature of the same size
+        for GBlock, skip in zip(self.GBlocks[begin:end], skips[begin:end]):
+            out = skip + GBlock(out, c)
+        return out
+
     def forward(self, LR, c, eval=False):
         with torch.cuda.amp.autocast() if self.mixed_precision and not eval else dummy_context_mgr() as mp:
             LR=F.interpolate(LR, size=(64, 64))
@@ -268,27 +365,21 @@ class NetG(nn.Module):
             R2=self.c2(self.R(R1))
             R3=self.c3(self.R(R2))
             R4=self.c4(self.R(R3))
-            c=c.float()          
+            if not isinstance(c, Conditioning):
+                c = self.condition(c)
+            code = c.code
             LR_fuse=self.TBlocks(R4,c)
 
-            out = self.mapping(self.fc_code(c).view(c.size(0), self.code_ch, self.code_sz, self.code_sz), c,LR_fuse)
-
-            i=1
-            for GBlock in self.GBlocks:           
-                if i==1:               
-                    out = GBlock(R4, c)       
-                    out=R4+out
-                if i==2:
-                    out = GBlock(out, c)
-                    out=R3+out
-                if i==3:
-                    out = GBlock(out, c)
-                    out=R2+out  
-                if i==4:
-                    out = GBlock(out, c)
-                    out=R1+out                   
-                i=i+1
+            out = self.mapping(code.view(code.size(0), self.code_ch, self.code_sz, self.code_sz), c,LR_fuse)
 
+            # only the first num_GBlocks G_Blocks have an encoder feature to add to and run
+            skips = [R4, R3, R2, R1][:self.num_GBlocks]
+            out = R4
+            for begin, end in segment_bounds(len(skips), self.checkpoint_blocks):
+                out = checkpointed(self.checkpoint_blocks, self.run_GBlocks, out, c, skips, begin, end)
+
+            if self.swin is not None:
+                out=self.swin(out)
             out=self.conv_after_body(out)+LR_residual
            
             out=self.conv_before_upsample(out)
@@ -481,22 +572,89 @@ class Affine(nn.Module):
         nn.init.zeros_(self.fc_beta.linear2.bias.data)
 
     def forward(self, x, y=None):
-        weight1 = self.fc_gamma(y)
-        bias1 = self.fc_beta(y)
+        if isinstance(y, Conditioning) and self in y.affine:
+            weight1, bias1 = y.affine[self]
+        elif isinstance(y, Conditioning):
+            weight1 = self.fc_gamma(y.c)
+            bias1 = self.fc_beta(y.c)
+        else:
+            weight1 = self.fc_gamma(y)
+            bias1 = self.fc_beta(y)
 
         if weight1.dim() == 1:
             weight1 = weight1.unsqueeze(0)
         if bias1.dim() == 1:
             bias1 = bias1.unsqueeze(0)
-        size = x.size()
 
-        weight1 = weight1.unsqueeze(-1).unsqueeze(-1).expand(size)
-        bias1 = bias1.unsqueeze(-1).unsqueeze(-1).expand(size)
+        weight1 = weight1.view(weight1.size(0), -1, 1, 1)
+        bias1 = bias1.view(bias1.size(0), -1, 1, 1)
 
-        first_stage=weight1 * x + bias1
+        # one broadcast multiply-add, no full size weight/bias maps
+        first_stage = torch.addcmul(bias1, weight1, x)
         return first_stage
 
 
+class FusedAffine:
+    """gamma/beta of many Affine layers for the same c with a few stacked matmuls.
+
+    The first Linear of every fc_gamma/fc_beta MLP reads the same c, so their
+    weights are concatenated into one matmul. The second Linears are grouped
+    by shape and run as one baddbmm per group. Same results as calling each
+    MLP, up to float rounding. Outside autograd the stacked weights are kept
+    until a parameter changes (moved, loaded or updated in place).
+    """
+    def __init__(self, affines):
+        self.affines = list(affines)
+        self.mlps = [mlp for m in self.affines for mlp in (m.fc_gamma, m.fc_beta)]
+        # order the MLPs by second layer shape so every group is a contiguous slice of the hidden units
+        order = sorted(range(len(self.mlps)), key=lambda i: tuple(self.mlps[i].linear2.weight.shape))
+        self.order, self.groups = order, []
+        begin = 0
+        while begin < len(order):
+            end = begin
+            while end < len(order) and self.mlps[order[end]].linear2.weight.shape == self.mlps[order[begin]].linear2.weight.shape:
+                end += 1
+            self.groups.append(order[begin:end])
+            begin = end
+        self.cache_key, self.cache = None, None
+
+    def parameters(self):
+        return [p for mlp in self.mlps for p in mlp.parameters()]
+
+    def stack_weights(self):
+        mlps = self.mlps
+        # stored as (in, out) so the matmuls read them contiguously
+        w1 = torch.cat([mlps[i].linear1.weight for i in self.order]).t().contiguous()
+        b1 = torch.cat([mlps[i].linear1.bias for i in self.order])
+        w2 = [torch.stack([mlps[i].linear2.weight for i in group]).transpose(1, 2).contiguous() for group in self.groups]
+        b2 = [torch.stack([mlps[i].linear2.bias for i in group]).unsqueeze(1) for group in self.groups]
+        return w1, b1, w2, b2
+
+    def weights(self):
+        params = self.parameters()
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            self.cache_key, self.cache = None, None
+            return self.stack_weights()
+        key = tuple((p.data_ptr(), p._version, p.dtype) for p in params)
+        if key != self.cache_key:
+            self.cache_key, self.cache = key, self.stack_weights()
+        return self.cache
+
+    def __call__(self, c):
+        """Returns a dict Affine -> (gamma, beta), each (B, num_features)."""
+        w1, b1, w2, b2 = self.weights()
+        hidden = F.relu(torch.addmm(b1, c, w1))
+        outs = [None] * len(self.mlps)
+        offset = 0
+        for group, w, b in zip(self.groups, w2, b2):
+            width = w.size(1)
+            h = hidden[:, offset:offset + len(group) * width].view(c.size(0), len(group), width).transpose(0, 1)
+            for i, y in zip(group, torch.baddbmm(b, h, w).unbind(0)):
+                outs[i] = y
+            offset += len(group) * width
+        return {m: (outs[2 * k], outs[2 * k + 1]) for k, m in enumerate(self.affines)}
+
+
 def get_G_in_out_chs(nf, imsize):
     layer_num = int(np.log2(imsize))-1
     channel_nums = [nf*min(2**idx, 8) for idx in range(layer_num)]
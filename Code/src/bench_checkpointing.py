@@ -0,0 +1,118 @@
+import os, sys
+import os.path as osp
+import time
+import weakref
+import argparse
+
+import torch
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.utils import merge_args_yaml, choose_model, dummy_context_mgr
+from lib.perpare import load_clip
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark activation checkpointing of the G step')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='batch size')
+    parser.add_argument('--iters', type=int, default=5,
+                        help='timed G steps per setting')
+    parser.add_argument('--segment', type=int, default=1,
+                        help='blocks per checkpoint segment')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device to benchmark on')
+    args = parser.parse_args()
+    return args
+
+
+def storage_info(tensor):
+    # (data_ptr, bytes) of the storage behind tensor; untyped_storage() is torch >= 2.0,
+    # the pinned 1.11 only has the typed storage()
+    if hasattr(tensor, 'untyped_storage'):
+        storage = tensor.untyped_storage()
+        return storage.data_ptr(), storage.nbytes()
+    storage = tensor.storage()
+    return storage.data_ptr(), storage.size() * storage.element_size()
+
+
+class SavedActivations:
+    # bytes of the tensors autograd keeps for the backward pass, on any device; tensors of
+    # graphs that were already freed (e.g. outputs that are overwritten) no longer count
+    def __init__(self):
+        self.saved = []
+
+    def pack(self, tensor):
+        self.saved.append((weakref.ref(tensor),) + storage_info(tensor))
+        return tensor
+
+    def unpack(self, tensor):
+        return tensor
+
+    def megabytes(self):
+        storages = {ptr: nbytes for ref, ptr, nbytes in self.saved if ref() is not None}
+        return sum(storages.values()) / 2**20
+
+
+def g_step(netG, netD, netC, image_encoder, LR, real, sent_emb, saved=None):
+    # the G step of lib.modules.train, the fake goes through the CLIP image encoder into D
+    netG.zero_grad()
+    with torch.autograd.graph.saved_tensors_hooks(saved.pack, saved.unpack) if saved is not None else dummy_context_mgr():
+        fake = netG(LR, sent_emb)
+        CLIP_fake, fake_emb = image_encoder(fake)
+        output = netC(netD(CLIP_fake), sent_emb)
+        errG = -output.mean() - torch.cosine_similarity(fake_emb, sent_emb).mean() + (fake - real).abs().mean()
+    del fake, CLIP_fake, fake_emb, output
+    kept = saved.megabytes() if saved is not None else None
+    errG.backward()
+    return kept
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+if __name__ == "__main__":
+    args = merge_args_yaml(parse_args())
+    device = torch.device(args.device)
+    NetG, NetD, NetC, CLIP_IMG_ENCODER, CLIP_TXT_ENCODER = choose_model(args.model)
+    CLIP = load_clip(args.clip4trn, device, args.clip_dtype).eval()
+    image_encoder = CLIP_IMG_ENCODER(CLIP).to(device).eval()
+    torch.manual_seed(0)
+    netG = NetG(args.nf, args.z_dim, args.cond_dim, args.imsize, args.ch_size, False, CLIP, args.swin).to(device)
+    netD = NetD(args.nf, args.imsize, args.ch_size, False).to(device)
+    netC = NetC(args.nf, args.cond_dim, False).to(device)
+    LR = torch.rand(args.batch_size, 3, args.imsize // 4, args.imsize // 4, device=device) * 2 - 1
+    real = torch.rand(args.batch_size, 3, args.imsize, args.imsize, device=device) * 2 - 1
+    sent_emb = torch.randn(args.batch_size, args.cond_dim, device=device)
+
+    k = args.segment
+    # each module on its own, so the savings are attributed per module, then both
+    settings = [('none', 0, 0), ('gblocks', k, 0), ('img_encoder', 0, k), ('both', k, k)]
+    print('setting       kept MB  saved MB  peak MB  ms/step  max grad diff')
+    ref, base = None, None
+    for name, gblocks, img_encoder in settings:
+        netG.set_checkpointing(gblocks)
+        image_encoder.checkpoint_blocks = img_encoder
+        kept = g_step(netG, netD, netC, image_encoder, LR, real, sent_emb, SavedActivations())
+        if base is None:
+            base = kept
+        grads = [p.grad.clone() for p in netG.parameters() if p.grad is not None]
+        if ref is None:
+            ref = grads
+        diff = max((a - b).abs().max().item() for a, b in zip(grads, ref))
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            g_step(netG, netD, netC, image_encoder, LR, real, sent_emb)
+        synchronize(device)
+        elapsed = (time.perf_counter() - start) / args.iters * 1000.
+        peak = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+        print('%-12s %8.0f %9.0f %8.0f %8.1f %14.3g' % (name, kept, base - kept, peak, elapsed, diff))
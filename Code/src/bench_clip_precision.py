@@ -0,0 +1,78 @@
+import os, sys
+import os.path as osp
+import copy
+import time
+import argparse
+
+import torch
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.utils import merge_args_yaml, choose_model
+from lib.perpare import load_clip, set_clip_precision, CLIP_DTYPES
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the CLIP image encoder calls of the D step per storage dtype')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='batch size')
+    parser.add_argument('--iters', type=int, default=10,
+                        help='timed iterations')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device to benchmark on')
+    parser.add_argument('--dtypes', type=str, default='',
+                        help='comma separated dtypes, empty picks float32,float16,bfloat16 on CUDA and float32,bfloat16 on CPU')
+    args = parser.parse_args()
+    return args
+
+
+def d_step_encoder_calls(image_encoder, real, fake):
+    # the encoder work of one D step: real features with gradients for MA-GP, fake features for the G step
+    real = real.detach().requires_grad_()
+    CLIP_real, real_emb = image_encoder(real)
+    CLIP_fake, fake_emb = image_encoder(fake)
+    grad = torch.autograd.grad(CLIP_real.float().sum(), real)[0]
+    return CLIP_real, CLIP_fake, grad
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+if __name__ == "__main__":
+    args = merge_args_yaml(parse_args())
+    device = torch.device(args.device)
+    if args.dtypes:
+        dtypes = args.dtypes.split(',')
+    else:
+        dtypes = ['float32', 'float16', 'bfloat16'] if device.type == 'cuda' else ['float32', 'bfloat16']
+    CLIP_IMG_ENCODER = choose_model(args.model)[3]
+    base = load_clip(args.clip4trn, device, 'float32').eval()
+    real = torch.rand(args.batch_size, 3, args.imsize, args.imsize, device=device) * 2 - 1
+    fake = torch.rand(args.batch_size, 3, args.imsize, args.imsize, device=device) * 2 - 1
+    ref = None
+    print('dtype       ms/step  peak MB  weights MB  max rel. err')
+    for name in dtypes:
+        CLIP = set_clip_precision(copy.deepcopy(base), CLIP_DTYPES[name])
+        image_encoder = CLIP_IMG_ENCODER(CLIP).to(device).eval()
+        weights = sum(p.numel() * p.element_size() for p in image_encoder.parameters()) / 2**20
+        d_step_encoder_calls(image_encoder, real, fake)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            CLIP_real, CLIP_fake, grad = d_step_encoder_calls(image_encoder, real, fake)
+        synchronize(device)
+        elapsed = (time.perf_counter() - start) / args.iters * 1000.
+        peak = torch.cuda.max_memory_allocated() / 2**20 if device.type == 'cuda' else float('nan')
+        if ref is None:
+            ref = CLIP_real.detach().float()
+        err = ((CLIP_real.detach().float() - ref).abs().max() / ref.abs().max()).item()
+        print('%-10s %8.1f %8.0f %11.0f %13.4f' % (name, elapsed, peak, weights, err))
+        del CLIP, image_encoder, CLIP_real, CLIP_fake, grad
@@ -0,0 +1,100 @@
+import os, sys
+import os.path as osp
+import time
+import argparse
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+from torch.autograd import DeviceType
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.utils import merge_args_yaml, choose_model
+from lib.perpare import load_clip
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the fused Affine conditioning of NetG')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='sentence embeddings per call')
+    parser.add_argument('--iters', type=int, default=50,
+                        help='timed iterations')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device to benchmark on')
+    args = parser.parse_args()
+    return args
+
+
+def count_kernels(fn, device):
+    # device kernels on GPU, leaf operators on CPU
+    activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if device.type == 'cuda' else [])
+    with profile(activities=activities) as prof:
+        fn()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+    if device.type == 'cuda':
+        return sum(1 for evt in prof.events() if evt.device_type == DeviceType.CUDA)
+    return sum(1 for evt in prof.events() if len(evt.cpu_children) == 0)
+
+
+def time_fn(fn, device, iters):
+    for _ in range(5):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+def check_unused_grads(netG, LR, c):
+    # a backward through forward must leave the parameters off the output path without gradients
+    netG.zero_grad(set_to_none=True)
+    netG(LR, c).mean().backward()
+    unused = [netG.mapping, netG.TBlocks, netG.fc_code] + list(netG.GBlocks[netG.num_GBlocks:])
+    unused_ids = set(id(p) for m in unused for p in m.parameters())
+    leaked = [name for name, p in netG.named_parameters() if id(p) in unused_ids and p.grad is not None]
+    reached = [m for m in netG.fused_affine.affines if m.fc_gamma.linear2.weight.grad is None]
+    netG.zero_grad(set_to_none=True)
+    if leaked or reached:
+        raise RuntimeError('Gradients of unused parameters: %s, used Affines without gradients: %d' % (leaked, len(reached)))
+    print('Unused parameters keep grad None: %d checked' % (len(unused_ids)))
+
+
+def expanded_modulation(gamma, beta, x):
+    # the modulation as Affine.forward used to apply it
+    size = x.size()
+    return gamma.unsqueeze(-1).unsqueeze(-1).expand(size) * x + beta.unsqueeze(-1).unsqueeze(-1).expand(size)
+
+
+if __name__ == "__main__":
+    args = merge_args_yaml(parse_args())
+    device = torch.device(args.device)
+    NetG = choose_model(args.model)[0]
+    netG = NetG(args.nf, args.z_dim, args.cond_dim, args.imsize, args.ch_size, False, load_clip(args.clip4trn, device, args.clip_dtype), args.swin)
+    netG = netG.to(device).eval()
+    c = torch.randn(args.batch_size, args.cond_dim, device=device)
+    check_unused_grads(netG.train(), torch.rand(args.batch_size, 3, 64, 64, device=device) * 2 - 1, c)
+    netG.eval()
+    unit = 'kernels' if device.type == 'cuda' else 'ops'
+    with torch.no_grad():
+        ref = netG.condition(c, fused=False).affine
+        new = netG.condition(c, fused=True).affine
+        err = max((ref[m][i] - new[m][i]).abs().max().item() for m in ref for i in (0, 1))
+        print('Affine layers: %d, max |fused - per module| = %.3g' % (len(ref), err))
+        for fused in (False, True):
+            fn = lambda: netG.condition(c, fused=fused)
+            print('%-22s %s: %5d  latency: %.3f ms' % ('fused' if fused else 'per module', unit,
+                  count_kernels(fn, device), time_fn(fn, device, args.iters)))
+        gamma, beta = ref[next(iter(ref))]
+        x = torch.randn(args.batch_size, gamma.size(1), 64, 64, device=device)
+        for name, fn in (('expand * x + expand', lambda: expanded_modulation(gamma, beta, x)),
+                         ('addcmul', lambda: torch.addcmul(beta.view(*beta.shape, 1, 1), gamma.view(*gamma.shape, 1, 1), x))):
+            print('%-22s %s: %5d  latency: %.3f ms' % (name, unit, count_kernels(fn, device), time_fn(fn, device, args.iters)))
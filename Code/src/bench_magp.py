@@ -0,0 +1,103 @@
+import os, sys
+import os.path as osp
+import time
+import argparse
+
+import torch
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.utils import merge_args_yaml, choose_model
+from lib.perpare import load_clip
+from lib.modules import MAGP, predict_loss
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the D step with every-step and lazy MA-GP')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help='batch size')
+    parser.add_argument('--iters', type=int, default=8,
+                        help='timed D steps per interval')
+    parser.add_argument('--intervals', type=str, default='1,4,16',
+                        help='comma separated MA-GP intervals, savings are relative to the first')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu',
+                        help='device to benchmark on')
+    args = parser.parse_args()
+    return args
+
+
+def concat_ma_gp(img, sent, out):
+    # the penalty as originally written, for the parity check
+    grads = torch.autograd.grad(out, (img, sent), torch.ones_like(out), retain_graph=True, create_graph=True)
+    grad = torch.cat((grads[0].view(grads[0].size(0), -1), grads[1].view(grads[1].size(0), -1)), dim=1)
+    return 2.0 * torch.mean(torch.sqrt(torch.sum(grad ** 2, dim=1)) ** 6)
+
+
+def d_step(magp, image_encoder, netD, netC, optimizerD, real, fake, sent_emb):
+    # the D step of lib.modules.train without the generator forward
+    optimizerD.zero_grad()
+    regularize = magp.required()
+    CLIP_real, _ = image_encoder(real)
+    if regularize:
+        CLIP_real = CLIP_real.detach().requires_grad_()
+        sent_emb = sent_emb.detach().requires_grad_()
+    real_feats = netD(CLIP_real)
+    pred_real, errD_real = predict_loss(netC, real_feats, sent_emb, negtive=False)
+    mis_sent_emb = torch.cat((sent_emb[1:], sent_emb[0:1]), dim=0).detach()
+    _, errD_mis = predict_loss(netC, real_feats, mis_sent_emb, negtive=True)
+    CLIP_fake, _ = image_encoder(fake)
+    _, errD_fake = predict_loss(netC, netD(CLIP_fake.detach()), sent_emb, negtive=True)
+    errD = errD_real + (errD_fake + errD_mis) / 2.0 + magp(CLIP_real, sent_emb, pred_real)
+    errD.backward()
+    optimizerD.step()
+    magp.step()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+if __name__ == "__main__":
+    args = merge_args_yaml(parse_args())
+    device = torch.device(args.device)
+    NetG, NetD, NetC, CLIP_IMG_ENCODER, CLIP_TXT_ENCODER = choose_model(args.model)
+    CLIP = load_clip(args.clip4trn, device, args.clip_dtype).eval()
+    image_encoder = CLIP_IMG_ENCODER(CLIP).to(device).eval()
+    for p in image_encoder.parameters():
+        p.requires_grad = False
+    netD = NetD(args.nf, args.imsize, args.ch_size, False).to(device)
+    netC = NetC(args.nf, args.cond_dim, False).to(device)
+    optimizerD = torch.optim.Adam(list(netD.parameters()) + list(netC.parameters()), lr=args.lr_d, betas=(0.0, 0.9))
+    real = torch.rand(args.batch_size, 3, args.imsize, args.imsize, device=device) * 2 - 1
+    fake = torch.rand(args.batch_size, 3, args.imsize, args.imsize, device=device) * 2 - 1
+    sent_emb = torch.randn(args.batch_size, args.cond_dim, device=device)
+
+    # the per-sample norm form against the concatenated gradients
+    CLIP_real = image_encoder(real)[0].detach().requires_grad_()
+    sent = sent_emb.clone().requires_grad_()
+    pred_real = netC(netD(CLIP_real), sent)
+    new, old = MAGP()(CLIP_real, sent, pred_real), concat_ma_gp(CLIP_real, sent, pred_real)
+    print('MA-GP %.6g, concatenated gradients %.6g, rel. diff %.2g' % (new.item(), old.item(), ((new - old).abs() / old.abs()).item()))
+
+    print('interval  ms/D step  saved ms/step  saved')
+    base = None
+    for interval in [int(k) for k in args.intervals.split(',')]:
+        magp = MAGP(interval)
+        for step in range(interval):
+            d_step(magp, image_encoder, netD, netC, optimizerD, real, fake, sent_emb)
+        # whole multiples of the interval, so each run has its share of regularized steps
+        steps = max(args.iters // interval, 1) * interval
+        synchronize(device)
+        start = time.perf_counter()
+        for step in range(steps):
+            d_step(magp, image_encoder, netD, netC, optimizerD, real, fake, sent_emb)
+        synchronize(device)
+        elapsed = (time.perf_counter() - start) / steps * 1000.
+        if base is None:
+            base = elapsed
+        print('%8d %10.1f %14.1f %5.1f%%' % (interval, elapsed, base - elapsed, (base - elapsed) / base * 100.))
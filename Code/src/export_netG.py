@@ -0,0 +1,68 @@
+import os, sys
+import os.path as osp
+import time
+import argparse
+
+import torch
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.pipeline import CLIPSRPipeline
+from lib.export import export_netG, load_exported
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export NetG as a TorchScript graph')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='state_epoch_*.pth to load NetG from')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--out', type=str, default='netG_traced.pt',
+                        help='where to save the exported generator')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='batch size the graph is traced for')
+    parser.add_argument('--device', type=str, default='cpu',
+                        help='device to trace and benchmark on')
+    parser.add_argument('--benchmark', type=int, default=10,
+                        help='timed iterations comparing eager, traced and torch.compile, 0 skips')
+    args = parser.parse_args()
+    return args
+
+
+def latency(fn, iters, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iters):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iters * 1000.
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    device = torch.device(args.device)
+    pipe = CLIPSRPipeline.from_pretrained(args.checkpoint, args.cfg_file, device, args.model)
+    netG = pipe.netG
+    cond_dim = netG.fc_code.in_features
+    export_netG(netG, args.out, args.batch_size, 64, cond_dim, device)
+    exported = load_exported(args.out, device)
+    print('Saved %s' % (args.out))
+
+    LR = torch.rand(args.batch_size, 3, 64, 64, device=device) * 2 - 1
+    c = pipe.encode_text(['a photo'] * args.batch_size).float()
+    with torch.no_grad():
+        ref = netG(LR, c, eval=True)
+        print('max |traced - eager| = %.3g' % ((exported(LR, c) - ref).abs().max().item()))
+        if args.benchmark > 0:
+            print('eager:    %.2f ms' % (latency(lambda: netG(LR, c, eval=True), args.benchmark, device)))
+            print('traced:   %.2f ms' % (latency(lambda: exported(LR, c), args.benchmark, device)))
+            try:
+                compiled = torch.compile(netG)
+                print('compiled: %.2f ms' % (latency(lambda: compiled(LR, c, eval=True), args.benchmark, device)))
+            except Exception as e:
+                print('torch.compile unavailable: %s' % (str(e).splitlines()[0]))
@@ -0,0 +1,57 @@
+import os, sys
+import os.path as osp
+import time
+import argparse
+
+import numpy as np
+import torch
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.pipeline import CLIPSRPipeline
+from lib.export import export_onnx
+from lib.onnx_backend import OnnxSRBackend
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export NetG and the CLIP text encoder to ONNX')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='state_epoch_*.pth to load NetG from')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--out_dir', type=str, default='onnx',
+                        help='directory for netG.onnx, text_encoder.onnx and meta.json')
+    parser.add_argument('--batch_size', type=int, default=1,
+                        help='batch size the generator graph is exported for')
+    parser.add_argument('--opset', type=int, default=14,
+                        help='ONNX opset version, the pinned torch 1.11 exports up to 15')
+    parser.add_argument('--atol', type=float, default=1e-3,
+                        help='largest accepted difference to the PyTorch outputs')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    pipe = CLIPSRPipeline.from_pretrained(args.checkpoint, args.cfg_file, 'cpu', args.model)
+    cond_dim = pipe.netG.fc_code.in_features
+    export_onnx(pipe.netG, pipe.text_encoder, args.out_dir, args.batch_size, 64, cond_dim, opset=args.opset)
+    print('Saved %s' % (args.out_dir))
+
+    # parity of both graphs against PyTorch, with a partial last batch
+    backend = OnnxSRBackend(args.out_dir)
+    captions = ['a bird with a red head', 'a small grey bird with short beak', 'this bird is yellow'][:args.batch_size + 1]
+    LR = np.random.RandomState(0).uniform(-1, 1, (len(captions), 3, 64, 64)).astype(np.float32)
+    with torch.no_grad():
+        sent_emb = pipe.encode_text(captions).float()
+        ref = pipe.netG(torch.from_numpy(LR), sent_emb, eval=True).numpy()
+    text_err = np.abs(backend.encode_text(captions) - sent_emb.numpy()).max()
+    start = time.perf_counter()
+    SR = backend(LR, captions)
+    elapsed = time.perf_counter() - start
+    sr_err = np.abs(SR - ref).max()
+    print('max |onnx - torch|: text encoder %.3g, NetG %.3g (%.1f ms for %d images)' % (text_err, sr_err, elapsed * 1000., len(captions)))
+    if max(text_err, sr_err) > args.atol:
+        raise RuntimeError('ONNX outputs differ from PyTorch by more than %g.' % (args.atol))
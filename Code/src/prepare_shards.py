@@ -0,0 +1,26 @@
+import os, sys
+import os.path as osp
+import argparse
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.utils import merge_args_yaml
+from lib.datasets import prepare_shards
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Precompute HR/LR shards')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--shard_size', type=int, default=1024,
+                        help='maximum size of one shard file in MB')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = merge_args_yaml(parse_args())
+    if not args.shard_dir:
+        raise ValueError('Set shard_dir in %s before writing shards.' % args.cfg_file)
+    for split in ['train', 'test']:
+        prepare_shards(args, split, shard_size=args.shard_size << 20)
@@ -0,0 +1,39 @@
+import os, sys
+import os.path as osp
+import argparse
+
+import torch
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.utils import merge_args_yaml, choose_model
+from lib.perpare import load_clip
+from lib.datasets import prepare_text_cache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Precompute CLIP text embeddings')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='captions per text encoder pass')
+    parser.add_argument('--gpu_id', type=int, default=0,
+                        help='gpu id')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = merge_args_yaml(parse_args())
+    if not args.text_cache:
+        raise ValueError('Set text_cache in %s before writing the cache.' % args.cfg_file)
+    if args.cuda:
+        torch.cuda.set_device(args.gpu_id)
+        args.device = torch.device("cuda")
+    else:
+        args.device = torch.device('cpu')
+    CLIP_TXT_ENCODER = choose_model(args.model)[4]
+    text_encoder = CLIP_TXT_ENCODER(load_clip(args.clip4trn, args.device, args.clip_dtype)).to(args.device).eval()
+    prepare_text_cache(args, text_encoder, batch_size=args.batch_size)
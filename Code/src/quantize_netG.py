@@ -0,0 +1,93 @@
+import os, sys
+import os.path as osp
+import time
+import argparse
+
+import torch
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.utils import merge_args_yaml
+from lib.perpare import prepare_dataset
+from lib.datasets import prepare_data
+from lib.pipeline import CLIPSRPipeline
+from lib.psnr_ssim import PSNR_SSIM_Meter
+from lib.quantize import quantize_netG
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Post-training int8 quantization of NetG')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='state_epoch_*.pth to load NetG from')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--calib_batches', type=int, default=8,
+                        help='train batches used to calibrate the activation ranges')
+    parser.add_argument('--eval_batches', type=int, default=8,
+                        help='test batches used for the PSNR and latency report')
+    parser.add_argument('--batch_size', type=int, default=4,
+                        help='batch size')
+    parser.add_argument('--num_workers', type=int, default=2,
+                        help='dataloader workers')
+    parser.add_argument('--out', type=str, default='',
+                        help='save the quantized NetG here (torch.save), empty skips')
+    args = parser.parse_args()
+    return args
+
+
+def batches(dataset, text_encoder, args, num):
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                             drop_last=True, num_workers=args.num_workers)
+    out = []
+    for step, data in enumerate(dataloader):
+        if step == num:
+            break
+        imgs, LR, captions, CLIP_tokens, sent_emb, words_embs, keys = prepare_data(data, text_encoder, args.device)
+        out.append((imgs, LR, sent_emb.float()))
+    return out
+
+
+@torch.no_grad()
+def evaluate(netG, data, args):
+    meter = PSNR_SSIM_Meter(args.eval_crop_border, args.eval_y_channel)
+    netG(data[0][1], data[0][2], eval=True)
+    elapsed, outs = 0., []
+    for imgs, LR, sent_emb in data:
+        # only the forward pass is timed
+        start = time.perf_counter()
+        SR = netG(LR, sent_emb, eval=True).float()
+        elapsed += time.perf_counter() - start
+        meter.update(SR, imgs)
+        outs.append(SR)
+    elapsed = elapsed / len(data) * 1000.
+    psnr, ssim = meter.result()
+    return psnr, ssim, elapsed, outs
+
+
+if __name__ == "__main__":
+    args = merge_args_yaml(parse_args())
+    # int8 kernels are CPU only
+    args.device = torch.device('cpu')
+    args.shard_dir, args.text_cache = None, None
+    pipe = CLIPSRPipeline.from_pretrained(args.checkpoint, args.cfg_file, args.device, args.model)
+    calib = batches(prepare_dataset(args, 'train', None), pipe.text_encoder, args, args.calib_batches)
+    test = batches(prepare_dataset(args, 'test', None), pipe.text_encoder, args, args.eval_batches)
+
+    netG = pipe.netG
+    psnr, ssim, latency, SRs = evaluate(netG, test, args)
+    q_netG = quantize_netG(netG, [(LR, sent_emb) for imgs, LR, sent_emb in calib])
+    q_psnr, q_ssim, q_latency, q_SRs = evaluate(q_netG, test, args)
+    # how far the int8 outputs are from the float32 ones
+    fidelity = PSNR_SSIM_Meter()
+    for SR, q_SR in zip(SRs, q_SRs):
+        fidelity.update(q_SR, SR)
+    print('            PSNR     SSIM    ms/batch')
+    print('float32  %7.3f  %7.4f  %8.1f' % (psnr, ssim, latency))
+    print('int8     %7.3f  %7.4f  %8.1f' % (q_psnr, q_ssim, q_latency))
+    print('PSNR delta %.3f dB, SSIM delta %.4f, speedup %.2fx (batch %d, %d threads)'
+          % (q_psnr - psnr, q_ssim - ssim, latency / q_latency, args.batch_size, torch.get_num_threads()))
+    print('int8 vs float32 outputs: PSNR %.2f dB, SSIM %.4f' % fidelity.result())
+    if args.out:
+        torch.save(q_netG, args.out)
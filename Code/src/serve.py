@@ -0,0 +1,45 @@
+import os, sys
+import os.path as osp
+import argparse
+
+ROOT_PATH = osp.abspath(osp.join(osp.dirname(osp.abspath(__file__)),  ".."))
+sys.path.insert(0, ROOT_PATH)
+from lib.pipeline import CLIPSRPipeline
+from lib.server import MicroBatcher, make_server
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve text-guided SR over HTTP')
+    parser.add_argument('--cfg', dest='cfg_file', type=str, default='../cfg/Birds.yml',
+                        help='optional config file')
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='state_epoch_*.pth to load NetG from')
+    parser.add_argument('--model', type=str, default='net',
+                        help='the model for training')
+    parser.add_argument('--device', type=str, default='cuda',
+                        help='device to run NetG on')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on')
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='requests per NetG forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=10.,
+                        help='time the first request of a batch waits for more')
+    args = parser.parse_args()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    pipe = CLIPSRPipeline.from_pretrained(args.checkpoint, args.cfg_file, args.device, args.model)
+    batcher = MicroBatcher(pipe, args.max_batch_size, args.max_wait_ms / 1000.)
+    server = make_server(batcher, args.host, args.port)
+    print('Serving on http://%s:%d (POST /sr, GET /metrics)' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
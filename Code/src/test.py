@@ -29,8 +29,9 @@ from lib.perpare import prepare_dataloaders,prepare_models
 # from lib.modules import sample_one_batch as sample, test as test, train as train
 from lib.datasets import get_fix_data
 from lib.datasets import prepare_data
+from lib.psnr_ssim import PSNR_SSIM_Meter
+from lib.image_writer import AsyncImageWriter, to_uint8_grid
 from tqdm import tqdm, trange
-from skimage.metrics import structural_similarity as ssim
 import numpy as np
 
 
@@ -85,7 +86,7 @@ def main(args):
     #============================================ prepare dataloader, models, data
     train_dl, valid_dl ,train_ds, valid_ds, sampler = prepare_dataloaders(args)
 
-    CLIP4trn, CLIP4evl, image_encoder, text_encoder, netG, netD, netC = prepare_models(args)
+    CLIP4trn, CLIP4evl, image_encoder, text_encoder, netG, netD, netC, percep_loss = prepare_models(args)
 
     print('**************G_paras: ',params_count(netG))
     print('**************D_paras: ',params_count(netD)+params_count(netC))
@@ -121,9 +122,8 @@ def sample(dataloader, netG, img_save_dir, text_encoder, args):
     device = args.device
     loop = tqdm(total=len(dataloader))
     netG.eval()
-
-    psnr_values = []
-    ssim_values = []
+    meter = PSNR_SSIM_Meter(args.eval_crop_border, args.eval_y_channel)
+    img_writer = AsyncImageWriter(args.writer_workers, args.writer_queue)
 
     for step, data in enumerate(dataloader, 0):
         real, LR, captions, CLIP_tokens, sent_emb, words_embs, keys = prepare_data(data, text_encoder, device)
@@ -131,33 +131,20 @@ def sample(dataloader, netG, img_save_dir, text_encoder, args):
         with torch.no_grad():
             SR = generate_samples(LR, sent_emb, netG).to(device)
 
-        real_img = tensor2img(real)
-        sr_img = tensor2img(SR)
-
-        psnr_value = calculate_psnr(sr_img, real_img)
-        min_size = min(sr_img.shape[:2])
-        win_size = min(7, min_size)
-        if win_size >= 3:
-            ssim_value = ssim(sr_img, real_img, channel_axis=-1, data_range=255, win_size=win_size)
-        else:
-            ssim_value = 0
-
-
-        psnr_values.append(psnr_value)
-        ssim_values.append(ssim_value)
+        meter.update(SR, real)
 
         img_name = f"{step}.jpg"
         img_save_path = osp.join(img_save_dir, img_name)
 
-        vutils.save_image(SR.data, img_save_path, nrow=1, value_range=(-1, 1), normalize=True)
+        img_writer.save_image(to_uint8_grid(SR.data, nrow=1), img_save_path)
 
         loop.update(1)
         loop.set_description(f'Testing [{step}/{len(dataloader)}]')
 
     loop.close()
+    img_writer.close()
 
-    avg_psnr = np.mean(psnr_values)
-    avg_ssim = np.mean(ssim_values)
+    avg_psnr, avg_ssim = meter.result()
 
     print(f"\n=== Evaluation Results ===")
     print(f"Average PSNR: {avg_psnr:.4f} dB")
@@ -169,36 +156,6 @@ def generate_samples(LR, caption, model):
     with torch.no_grad():
         SR = model(LR, caption, eval=True)
     return SR
-def tensor2img(tensor, out_type=np.uint8, min_max=(-1, 1)):
-    tensor = tensor.squeeze().float().cpu().clamp_(*min_max)  # clamp
-    tensor = (tensor - min_max[0]) / \
-        (min_max[1] - min_max[0])  # to range [0,1]
-    n_dim = tensor.dim()
-    if n_dim == 4:
-        n_img = len(tensor)
-        img_np = make_grid(tensor, nrow=int(
-            math.sqrt(n_img)), normalize=False).detach().numpy()
-        img_np = np.transpose(img_np, (1, 2, 0))  # HWC, RGB
-    elif n_dim == 3:
-        img_np = tensor.detach().numpy()
-        img_np = np.transpose(img_np, (1, 2, 0))  # HWC, RGB
-    elif n_dim == 2:
-        img_np = tensor.numpy()
-    else:
-        raise TypeError(
-            'Only support 4D, 3D and 2D tensor. But received with dimension: {:d}'.format(n_dim))
-    if out_type == np.uint8:
-        img_np = (img_np * 255.0).round()
-        # Important. Unlike matlab, numpy.unit8() WILL NOT round by default.
-    return img_np.astype(out_type)
-def calculate_psnr(img1, img2):
-    # img1 and img2 have range [0, 255]
-    img1 = img1.astype(np.float64)
-    img2 = img2.astype(np.float64)
-    mse = np.mean((img1 - img2)**2)
-    if mse == 0:
-        return float('inf')
-    return 20 * math.log10(255.0 / math.sqrt(mse))
 
 
 if __name__ == "__main__":
@@ -25,9 +25,11 @@ sys.path.insert(0, ROOT_PATH)
 sys.path.append('/opt/data/private/carr/code/lib')
 from lib.utils import mkdir_p,get_rank,merge_args_yaml,get_time_stamp,save_args
 from lib.utils import load_models_opt,save_models_opt,save_models,load_npz,params_count
-from lib.perpare import prepare_dataloaders,prepare_models
-from lib.modules import sample_one_batch as sample, test as test, train as train
+from lib.perpare import prepare_dataloaders,prepare_models,clip_dtype
+from lib.modules import sample_one_batch as sample, test as test, train as train, MAGP
 from lib.datasets import get_fix_data
+from lib.feature_cache import FeatureCache
+from lib.profiler import StepProfiler, parse_trace_steps
 
 
 def parse_args():
@@ -101,11 +103,13 @@ def main(args):
     train_dl, valid_dl ,train_ds, valid_ds, sampler = prepare_dataloaders(args)
     
   
-    CLIP4trn, CLIP4evl, image_encoder, text_encoder, netG, netD, netC = prepare_models(args)
+    CLIP4trn, CLIP4evl, image_encoder, text_encoder, netG, netD, netC, percep_loss = prepare_models(args)
 
     print('**************G_paras: ',params_count(netG))
     print('**************D_paras: ',params_count(netD)+params_count(netC))
-    print('**************else: ', params_count(CLIP4trn) + params_count(CLIP4evl)+ params_count(image_encoder)+ params_count(text_encoder))
+    print('**************else: ', params_count(CLIP4trn) + params_count(image_encoder)+ (params_count(text_encoder) if text_encoder is not None else 0))
+    world_size = torch.distributed.get_world_size() if args.multi_gpus else 1
+    print('**************effective batch: ', args.batch_size * args.grad_accum_steps * world_size)
     GT,LR, fixed_sent, fixed_words,fixed_z = get_fix_data(train_dl, valid_dl,text_encoder, args)
 
 
@@ -134,6 +138,23 @@ def main(args):
         scaler_G = None
 
     # m1, s1 = load_npz(args.npz_path)
+    if args.feat_cache_size:
+        if not args.shard_dir:
+            raise ValueError('feat_cache_size needs shard_dir, the JPEG pipeline does not report its crops.')
+        if args.feat_cache_crops < 1:
+            raise ValueError('feat_cache_crops must be at least 1, free crops almost never repeat and miss the cache.')
+        version = '%s-%s' % (args.clip4trn['type'], clip_dtype(args.clip_dtype, args.device))
+        feat_cache = FeatureCache(args.feat_cache_size, args.feat_cache_dir, version, get_rank())
+    else:
+        feat_cache = None
+
+    # per-phase step timings, only logged on the main process
+    is_main = not ((args.multi_gpus==True) and (get_rank() != 0))
+    profiler = StepProfiler(enabled=args.profile and is_main, device=args.device, writer=writer,
+                            interval=args.profile_interval, window=args.profile_window,
+                            trace=parse_trace_steps(args.profile_trace), trace_dir=osp.join(log_dir, 'trace'))
+    # shared by all epochs, so the lazy MA-GP keeps its schedule across epoch boundaries
+    magp = MAGP(args.magp_interval, args.mixed_precision)
  
     start_epoch = 1
     # ==================================================load from checkpoint===================================
@@ -166,7 +187,7 @@ def main(args):
         torch.cuda.empty_cache()
 
        
-        train(train_dl, netG, netD, netC, text_encoder, image_encoder, optimizerG, optimizerD, scaler_G, scaler_D, writer,args)
+        train(train_dl, netG, netD, netC, text_encoder, image_encoder, optimizerG, optimizerD, scaler_G, scaler_D, writer,args, feat_cache, percep_loss, profiler, magp)
         torch.cuda.empty_cache()
         # ==============================================save============================================================
         if epoch%save_interval==0:
@@ -181,7 +202,7 @@ def main(args):
         # ============================================test===================================================
         if epoch%test_interval==0:
 
-            PSNR = test(valid_dl, text_encoder, netG,None, CLIP4evl, args.device, epoch, args.max_epoch, args.sample_times, args.z_dim, args.batch_size)
+            PSNR, CLIP_score = test(valid_dl, text_encoder, netG,None, CLIP4evl if args.clip_score else None, args.device, epoch, args.max_epoch, args.sample_times, args.z_dim, args.batch_size, args.eval_crop_border, args.eval_y_channel)
             torch.cuda.empty_cache()
             print("---------------------",PSNR,"-----------------------------")
 
@@ -191,11 +212,19 @@ def main(args):
         else:
             if epoch%test_interval==0:
                 writer.add_scalar('PSNR', PSNR, epoch)
-                # writer.add_scalar('CLIP_Score', TI_score, epoch)
                 print('The %d epoch PSNR: %.2f' % (epoch,PSNR))
+                if CLIP_score is not None:
+                    writer.add_scalar('CLIP_Score', CLIP_score, epoch)
+                    print('The %d epoch CLIP score: %.4f' % (epoch,CLIP_score))
             end_t = time.time()
             print('The epoch %d costs %.2fs'%(epoch, end_t-start_t))
+            if feat_cache is not None:
+                print('Real feature cache: %d entries, %d hits, %d misses'%(len(feat_cache), feat_cache.hits, feat_cache.misses))
+            if profiler.enabled:
+                profiler.save(osp.join(log_dir, 'profile.json'))
+                print(profiler.report())
             print("*"*40)
+    profiler.close()
 
 
 if __name__ == "__main__":